@@ -0,0 +1,405 @@
+#!/usr/bin/python3
+#
+# End-to-end latency benchmark for the bridge.  Runs the Katana
+# emulator in-process, starts katana_bridge_app against it in
+# virtual-port mode and drives it with a synthetic controller.
+#
+# Measured from the moment a controller message is sent to the moment
+# the last resulting sysex byte reaches the (emulated) amp:
+#
+#   recall  - PC for a stored preset --> DT1 carrying its last byte.
+#             Presets differ in a random share of their bytes, so this
+#             times the differential sends of real preset changes
+#   full    - CC#4 resync --> last byte of a full send of the preset
+#   cc      - CC#70 expression pedal --> volume pedal DT1 carrying its
+#             value, or the value of a later CC that superseded it
+#             (the bridge coalesces pedal sweeps; those CCs are
+#             counted as 'coalesced', not 'dropped')
+#   capture - CC#3 x3 + PC --> final volume write of the ack pulse
+#
+# Results are written as JSON and may be compared against a previous
+# run:
+#
+#   bench_bridge.py --out base.json
+#   bench_bridge.py --baseline base.json --tolerance 0.2
+#
+# Exit status is 1 if any metric regressed beyond tolerance.
+#
+
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import tempfile
+import threading
+import subprocess
+
+import mido
+
+from globals import *
+from katana import Katana
+from katana_emulator import Emulator
+from panel_preset import PanelPreset, ParmRec
+from range import Range
+from cc_map import CCMap
+from parameter_registry import ParameterRegistry
+
+CONTROL_PORT = 'BENCH_CTRL'
+
+# Nearest-rank percentile of a list of samples
+def percentile( values, pct ):
+    if not values:
+        return None
+    ordered = sorted( values )
+    rank = int( round( pct / 100 * (len( ordered ) - 1) ) )
+    return ordered[rank]
+
+def summarize( latencies, sent, elapsed, deadline ):
+    ms = [ lat * 1000 for lat in latencies ]
+    late = len( [ lat for lat in latencies if lat > deadline ] )
+    return {
+        "sent": sent,
+        "completed": len( latencies ),
+        "dropped": sent - len( latencies ),
+        "late": late,
+        "p50_ms": percentile( ms, 50 ),
+        "p95_ms": percentile( ms, 95 ),
+        "p99_ms": percentile( ms, 99 ),
+        "max_ms": max( ms ) if ms else None,
+        "throughput": len( latencies ) / elapsed if elapsed > 0 else 0.0
+    }
+
+# Record every message reaching the emulated amp with a timestamp
+class Probe:
+
+    def __init__( self ):
+        self.lock = threading.Lock()
+        self.events = []
+
+    def __call__( self, msg ):
+        now = time.perf_counter()
+        if msg.type != 'sysex':
+            kind = msg.type
+            addr = None
+            size = 0
+        else:
+            kind = 'rq1' if msg.data[6] == QUERY_PREFIX[6] else 'dt1'
+            addr = tuple( msg.data[7:11] )
+            size = len( msg.data ) - 12
+
+        with self.lock:
+            self.events.append( (now, kind, addr, size, msg.data[11:-1]) )
+
+    def reset( self ):
+        with self.lock:
+            self.events = []
+
+    def snapshot( self ):
+        with self.lock:
+            return list( self.events )
+
+# A DT1 that can only have come from the expression pedal or the
+# capture acknowledgement.
+def is_volume_write( event ):
+    return event[1] == 'dt1' and event[2] == VOLUME_PEDAL_ADDR and event[3] == 1
+
+# Build a library of distinct presets from the emulator's memory image.
+# Each preset gets random values in a 'vary' share of its bytes
+# (seeded by program number, so runs are repeatable).
+def make_library( emulator, rangeObj, count, first_id=10, vary=0.25 ):
+    library = {}
+    for program in range( first_id, first_id + count ):
+        obj = PanelPreset()
+        obj.state = obj.Done
+        obj.id = program
+        rand = random.Random( program )
+        for rec in rangeObj.get_coords():
+            span = Katana.decode_array( rec['lastAddr'] ) - Katana.decode_array( rec['baseAddr'] )
+            for addr, data in emulator.image.read( rec['baseAddr'], span + 1 ):
+                data = [ rand.randrange( 128 ) if rand.random() < vary else byte for byte in data ]
+                obj.parms.append( ParmRec( tuple( addr ), tuple( data ), rec['name'] ) )
+
+        # Make each preset differ from its neighbours in the very last
+        # byte it writes.  That write always goes out last, whether the
+        # bridge sends full or differential presets, so it marks the
+        # end of the recall.
+        last = obj.parms[-1]
+        data = list( last.data )
+        data[-1] = program % 100
+        last.data = tuple( data )
+        library[program] = obj
+
+    return library
+
+# Scalar address and value of a preset's end-of-recall marker
+def marker( preset ):
+    last = preset.parms[-1]
+    return Katana.decode_array( last.addr ) + len( last.data ) - 1, last.data[-1]
+
+# Time at which each recall's marker byte reached the amp
+def match_markers( pcs, events ):
+    latencies = []
+    idx = 0
+    for sent, (addr, value) in pcs:
+        while idx < len( events ):
+            ev = events[idx]
+            idx += 1
+            if ev[0] < sent or ev[1] != 'dt1':
+                continue
+            start = Katana.decode_array( ev[2] )
+            if start <= addr < start + ev[3] and ev[4][addr - start] == value:
+                latencies.append( ev[0] - sent )
+                break
+    return latencies
+
+def write_library( filename, library ):
+    with open( filename, 'w' ) as outfh:
+        for rec in library.values():
+            rec.serialize( outfh )
+
+# Launch the bridge in virtual-port mode and wait for its controller
+# port to appear.
+def start_bridge( bridge, preset_file, amp_port, timeout=30 ):
+    proc = subprocess.Popen( [ sys.executable, bridge, CONTROL_PORT, '1',
+                               amp_port, '1', preset_file, 'virt' ] )
+    start = time.time()
+    while time.time() - start < timeout:
+        if proc.poll() != None:
+            raise RuntimeError( "Bridge exited with status %d" % proc.returncode )
+        for name in mido.get_output_names():
+            if CONTROL_PORT in name:
+                return proc
+        time.sleep( 0.1 )
+
+    proc.terminate()
+    raise RuntimeError( "Bridge did not open controller port" )
+
+def stop_bridge( proc ):
+    proc.send_signal( 2 )
+    try:
+        proc.wait( 5 )
+    except subprocess.TimeoutExpired:
+        proc.kill()
+
+# Fire PCs (and optionally a concurrent CC#70 sweep) at fixed rates.
+# 'ccmap' gives the data the bridge writes for each CC value.
+def run_recall( ctl, probe, library, count, pc_rate, cc_rate, settle, ccmap ):
+    probe.reset()
+    programs = list( library.keys() )
+    pcs = []
+    ccs = []
+
+    def pedal():
+        msg = mido.Message( 'control_change', channel=0, control=70 )
+        value = 0
+        step = 1
+        for i in range( int( count / pc_rate * cc_rate ) ):
+            msg.value = value
+            ccs.append( (time.perf_counter(), ccmap.lookup( 70, value )[1]) )
+            ctl.send( msg )
+            value += step
+            if value in (0, 127):
+                step = -step
+            time.sleep( 1 / cc_rate )
+
+    sweeper = None
+    if cc_rate > 0:
+        sweeper = threading.Thread( target=pedal )
+        sweeper.start()
+
+    msg = mido.Message( 'program_change', channel=0 )
+    for i in range( count ):
+        msg.program = programs[ i % len( programs ) ]
+        pcs.append( (time.perf_counter(), marker( library[msg.program] )) )
+        ctl.send( msg )
+        time.sleep( 1 / pc_rate )
+
+    if sweeper != None:
+        sweeper.join()
+    time.sleep( settle )
+
+    events = probe.snapshot()
+    volumes = [ (ev[0], tuple( ev[4] )) for ev in events if is_volume_write( ev ) ]
+
+    return match_markers( pcs, events ), pcs, match_settled( ccs, volumes ), ccs
+
+# Pair each CC, given as (time, data), with the first volume write
+# after it that carries its own data or that of a later CC sent before
+# the write: the bridge keeps only the latest pedal value, so that is
+# when the CC's effect has settled on the amp.  Returns (latencies,
+# coalesced), where 'coalesced' counts CCs whose own value was
+# superseded before it went out.  CCs never settled are left out.
+def match_settled( ccs, writes ):
+    latencies = []
+    coalesced = 0
+    first = 0
+    for when, data in writes:
+        last = first
+        while last < len( ccs ) and ccs[last][0] < when:
+            last += 1
+
+        # Latest CC this write can be carrying
+        match = None
+        for i in range( last - 1, first - 1, -1 ):
+            if ccs[i][1] == data:
+                match = i
+                break
+        if match == None:
+            continue
+
+        for i in range( first, match + 1 ):
+            latencies.append( when - ccs[i][0] )
+        coalesced += match - first
+        first = match + 1
+    return latencies, coalesced
+
+# Force full sends of 'preset' with the resync CC, after recalling it
+def run_full( ctl, probe, preset, count, rate, settle ):
+    ctl.send( mido.Message( 'program_change', channel=0, program=preset.id ) )
+    time.sleep( settle )
+
+    probe.reset()
+    msg = mido.Message( 'control_change', channel=0, control=4, value=127 )
+    sends = []
+    for i in range( count ):
+        sends.append( (time.perf_counter(), marker( preset )) )
+        ctl.send( msg )
+        time.sleep( 1 / rate )
+    time.sleep( settle )
+
+    return match_markers( sends, probe.snapshot() )
+
+def run_capture( ctl, probe, count, interval, first_id=100 ):
+    cc = mido.Message( 'control_change', channel=0, control=3, value=127 )
+    pc = mido.Message( 'program_change', channel=0 )
+    latencies = []
+    for i in range( count ):
+        for j in range( 3 ):
+            ctl.send( cc )
+            time.sleep( 0.02 )
+
+        probe.reset()
+        pc.program = first_id + (i % 20)
+        sent = time.perf_counter()
+        ctl.send( pc )
+
+        # Acknowledgement pulse is three volume writes
+        deadline = time.time() + interval
+        while time.time() < deadline:
+            volumes = [ ev for ev in probe.snapshot() if is_volume_write( ev ) ]
+            if len( volumes ) >= 3:
+                latencies.append( volumes[2][0] - sent )
+                break
+            time.sleep( 0.005 )
+
+    return latencies
+
+# Compare results against a baseline. Returns list of regression
+# descriptions (empty if none).
+def compare( results, baseline, tolerance ):
+    regressions = []
+    for scenario, stats in results.items():
+        base = baseline.get( scenario )
+        if base == None:
+            continue
+        for key in ('p50_ms', 'p95_ms', 'p99_ms'):
+            if stats[key] != None and base.get( key ) != None:
+                if stats[key] > base[key] * (1 + tolerance):
+                    regressions.append( "%s %s: %.2f > %.2f" % (scenario, key, stats[key], base[key]) )
+        if base.get( 'throughput' ) and stats['throughput'] < base['throughput'] * (1 - tolerance):
+            regressions.append( "%s throughput: %.2f < %.2f" % (scenario, stats['throughput'], base['throughput']) )
+        for key in ('dropped', 'late'):
+            if base.get( key ) != None and stats[key] > base[key]:
+                regressions.append( "%s %s: %d > %d" % (scenario, key, stats[key], base[key]) )
+    return regressions
+
+
+if __name__ == '__main__':
+    import argparse
+
+    scriptdir = os.path.dirname( os.path.abspath(__file__) )
+
+    parser = argparse.ArgumentParser( description="Bridge latency benchmark" )
+    parser.add_argument( '--bridge', default=scriptdir + '/katana_bridge_app' )
+    parser.add_argument( '--datadir', default=scriptdir + '/parameters/' )
+    parser.add_argument( '--presets', type=int, default=20, help="Library size" )
+    parser.add_argument( '--pcs', type=int, default=100, help="Number of recalls" )
+    parser.add_argument( '--pc-rate', type=float, default=4.0, help="PC messages/sec" )
+    parser.add_argument( '--cc-rate', type=float, default=50.0, help="CC#70 messages/sec (0 = off)" )
+    parser.add_argument( '--vary', type=float, default=0.25, help="Share of bytes randomized per preset" )
+    parser.add_argument( '--full', type=int, default=20, help="Number of forced full sends" )
+    parser.add_argument( '--captures', type=int, default=5 )
+    parser.add_argument( '--latency', type=float, default=0.002, help="Emulated amp per-chunk latency" )
+    parser.add_argument( '--jitter', type=float, default=0.001 )
+    parser.add_argument( '--deadline-ms', type=float, default=100.0, help="Recall/CC latency considered late" )
+    parser.add_argument( '--capture-deadline-ms', type=float, default=2000.0 )
+    parser.add_argument( '--out', help="Write JSON results here" )
+    parser.add_argument( '--baseline', help="JSON results of an earlier run" )
+    parser.add_argument( '--tolerance', type=float, default=0.2 )
+    args = parser.parse_args()
+
+    mido.set_backend( 'mido.backends.rtmidi' )
+
+    emulator = Emulator( args.datadir, scriptdir + '/doc/katana_sysex.txt',
+                         args.latency, args.jitter )
+    probe = Probe()
+    emulator.monitor = probe
+    emulator.open()
+
+    workdir = tempfile.mkdtemp( prefix='katana_bench' )
+    preset_file = os.path.join( workdir, 'preset.data' )
+    library = make_library( emulator, Range( args.datadir + 'ranges.json' ), args.presets,
+                            vary=args.vary )
+    ccmap = CCMap( args.datadir + 'cc_map.json', ParameterRegistry( args.datadir ) )
+    write_library( preset_file, library )
+
+    proc = start_bridge( args.bridge, preset_file, 'KATANA:KATANA MIDI 1' )
+    ctl = mido.open_output( CONTROL_PORT )
+
+    results = {}
+    try:
+        start = time.perf_counter()
+        recall, pcs, cc, ccs = run_recall( ctl, probe, library, args.pcs,
+                                           args.pc_rate, args.cc_rate, settle=1.0, ccmap=ccmap )
+        elapsed = time.perf_counter() - start
+        results['recall'] = summarize( recall, len( pcs ), elapsed, args.deadline_ms / 1000 )
+        if args.cc_rate > 0:
+            latencies, coalesced = cc
+            results['cc'] = summarize( latencies, len( ccs ), elapsed, args.deadline_ms / 1000 )
+            results['cc']['coalesced'] = coalesced
+
+        if args.full > 0:
+            start = time.perf_counter()
+            full = run_full( ctl, probe, library[ min( library ) ], args.full, args.pc_rate, settle=1.0 )
+            elapsed = time.perf_counter() - start
+            results['full'] = summarize( full, args.full, elapsed, args.deadline_ms / 1000 )
+
+        if args.captures > 0:
+            start = time.perf_counter()
+            capture = run_capture( ctl, probe, args.captures, 10.0 )
+            elapsed = time.perf_counter() - start
+            results['capture'] = summarize( capture, args.captures, elapsed,
+                                            args.capture_deadline_ms / 1000 )
+    finally:
+        ctl.close()
+        stop_bridge( proc )
+        emulator.close()
+        shutil.rmtree( workdir )
+
+    report = { "config": vars( args ), "results": results }
+    print( json.dumps( results, indent=4 ) )
+
+    if args.out:
+        with open( args.out, 'w' ) as outfh:
+            json.dump( report, outfh, indent=4 )
+
+    if args.baseline:
+        with open( args.baseline ) as fh:
+            baseline = json.load( fh )['results']
+        regressions = compare( results, baseline, args.tolerance )
+        for line in regressions:
+            print( "REGRESSION: " + line )
+        if regressions:
+            sys.exit( 1 )
@@ -0,0 +1,101 @@
+#!/usr/bin/python3
+#
+# Benchmark: reading DSP knob and color-button state from the amp.
+# Compares the original scan (one RQ1/DT1 round trip per byte) with
+# the batched block reads in ColorButtons.  Runs against the Katana
+# emulator on a virtual port, so no hardware is needed; use --latency
+# to model the real amp's reply time.
+#
+# Usage: bench_color.py [--iterations N] [--latency SEC]
+#
+
+import os
+import time
+import argparse
+
+from katana import Katana
+from katana_emulator import Emulator
+from color_buttons import ColorButtons
+
+# The knob scan as it was before block reads
+def original_read_knobs( buttons, katana ):
+    offsets = buttons.knob_state['knobOffset']
+    knob_base_addr = buttons.knob_state['baseAddr']
+    assign_base_addr = buttons.assign_index['baseAddr']
+    result = []
+    for knob in buttons.knobs:
+        state = katana.query_sysex_byte( knob_base_addr, offsets[knob] )
+        ( range, color ) = buttons.knob_state_xlate[state]
+        if range == "none": continue
+        rec = buttons.assign_index['knob'][knob]['range'][range]
+        type = katana.query_sysex_byte( assign_base_addr, rec['colorOffset'][color] )
+        result.append( {"group":rec['group'], "category":rec['category'], "type":type} )
+    return result
+
+# The color assignment scan as it was before block reads
+def original_read_color_assign( buttons, katana ):
+    assign_base_addr = buttons.assign_index['baseAddr']
+    active_base_addr = buttons.active_index['baseAddr']
+    result = []
+    offsets = buttons.active_index['categoryOffset']
+    for category in buttons.simple:
+        color_enum = katana.query_sysex_byte( active_base_addr, offsets[category] )
+        color = buttons.enum2name[color_enum]
+        type = katana.query_sysex_byte( assign_base_addr, buttons.assign_index2[category][color] )
+        result.append( {"group":"simple", "category":category, "type":type} )
+    for category in buttons.complex:
+        for color in buttons.name2enum.keys():
+            type = katana.query_sysex_byte( assign_base_addr, buttons.assign_index2[category][color] )
+            result.append( {"group":"complex", "category":category, "type":type} )
+    return result
+
+# Run 'scan' and return (result, round trips, seconds) per call
+def measure( emulator, scan, iterations ):
+    before = emulator.stats['rq1']
+    start = time.perf_counter()
+    for i in range( iterations ):
+        result = scan()
+    elapsed = time.perf_counter() - start
+    return result, (emulator.stats['rq1'] - before) / iterations, elapsed / iterations
+
+def run( emulator, katana, buttons, iterations ):
+    rows = []
+    for name, old, new in (
+            ('read_knobs', original_read_knobs, ColorButtons.read_knobs),
+            ('read_color_assign', original_read_color_assign, ColorButtons.read_color_assign) ):
+        old_result, old_trips, old_time = measure( emulator, lambda: old( buttons, katana ), iterations )
+        new_result, new_trips, new_time = measure( emulator, lambda: new( buttons, katana ), iterations )
+        if old_result != new_result:
+            print( "MISMATCH in %s:\n  %s\n  %s" % (name, old_result, new_result) )
+        rows.append( (name, old_trips, old_time, new_trips, new_time) )
+
+    print( "%-18s %18s %18s" % ('', 'per-byte', 'batched') )
+    for name, old_trips, old_time, new_trips, new_time in rows:
+        print( "%-18s %3d trips %6.1f ms %3d trips %6.1f ms  (%.1fx)" %
+               (name, old_trips, old_time * 1000, new_trips, new_time * 1000, old_time / new_time) )
+    return rows
+
+
+if __name__ == '__main__':
+    scriptdir = os.path.dirname( os.path.abspath(__file__) )
+
+    parser = argparse.ArgumentParser( description="ColorButtons scan benchmark" )
+    parser.add_argument( '--iterations', type=int, default=20 )
+    parser.add_argument( '--latency', type=float, default=0.004, help="Emulated amp per-chunk latency" )
+    parser.add_argument( '--jitter', type=float, default=0.001 )
+    args = parser.parse_args()
+
+    emulator = Emulator( scriptdir + '/parameters/', scriptdir + '/doc/katana_sysex.txt',
+                         args.latency, args.jitter )
+    emulator.open()
+
+    # Every scan must go to the (emulated) amp for the comparison to
+    # mean anything
+    katana = Katana( 'KATANA:KATANA MIDI 1', 0, cache_reads=False )
+    buttons = ColorButtons( scriptdir + '/parameters/color_assign.json' )
+    try:
+        run( emulator, katana, buttons, args.iterations )
+    finally:
+        katana.inport.close()
+        katana.outport.close()
+        emulator.close()
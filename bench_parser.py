@@ -0,0 +1,178 @@
+#!/usr/bin/python3
+#
+# Benchmark: loading a large text preset library.  Compares the
+# original line-by-line parser (regex + handler dispatch, per-token
+# int(hex, 16), compile on every preset) with PresetParser, and checks
+# that the result re-serializes byte-for-byte.
+#
+# Usage: bench_parser.py [presets]     (default 10000)
+#
+
+import io
+import os
+import re
+import sys
+import json
+import time
+import random
+
+from katana import Katana
+from panel_preset import PanelPreset, ParmRec
+from preset_parser import PresetParser
+
+# The text parser as it was before PresetParser
+class OriginalPreset( PanelPreset ):
+
+    @staticmethod
+    def get_from_file( infh ):
+        rx = re.compile( r'#\s*' )
+
+        lineNum = 0
+        obj = OriginalPreset()
+        for line in infh:
+            lineNum += 1
+            line = line.strip()
+            if len( line ) == 0: continue
+            if re.match( r'^#', line ):
+                # If we're in a preset stanza gather comments, removing any
+                # '#' char prefix.
+                if obj.curr_rec != None:
+                    obj.curr_rec.memo += rx.sub( '', line )
+                continue
+
+            try:
+                type, value = line.split( ' ', 1 )
+            except ValueError:
+                print( "Parse error at line %d. Expected more than one token." % lineNum )
+                sys.exit( 1 )
+
+            # First token in input line names the handler.  
+            handler = getattr( obj, type, None )
+            if handler == None:
+                print( "Parse error at line %d. Line type %s unknown" % (lineNum, type) )
+                sys.exit( 1 )
+            else:
+                handler( value, lineNum )
+
+            if obj.state == obj.Done:
+                yield obj
+                obj = OriginalPreset()
+                
+        if obj.state != obj.Start:
+            print( "Parse error at line %d." % lineNum )
+
+    # State machine handlers for parsing data file:
+        
+    def _preset( self, value, lineNum ):
+        if self.state != self.Start:
+            print( "Phase error at line %d. Expected Start, but was %d." % (lineNum, self.state) )
+            sys.exit( 1 )
+
+        try:
+            self.id = int( value )
+            self.curr_rec = ParmRec()
+            self.state = self.SawId
+
+        except ValueError:
+            print( "Parse error at line %d. Expecting single integer." )
+            sys.exit( 1 )
+
+    def _addr( self, value, lineNum ):
+        if self.state != self.SawId and self.state != self.SawData:
+            print( "Phase error at line %d. Expected SawId or SawData, but was %d." % (lineNum, self.state) )
+            sys.exit( 1 )
+
+        address_bytes = []
+        for hex in value.split():
+            address_bytes.append( int(hex,16) )
+
+        self.curr_rec.addr = tuple( address_bytes )
+        self.state = self.SawAddr
+
+    def _data( self, value, lineNum ):
+        if self.state != self.SawAddr: 
+            print( "Phase error at line %d. Expected SawAddr, but was %d." % (lineNum, self.state) )
+            sys.exit( 1 )
+
+        data = []
+        for hex in value.split():
+            data.append( int(hex,16) )
+
+        self.curr_rec.data = tuple( data )
+        self.parms.append( self.curr_rec )
+        self.by_addr[ self.curr_rec.addr ] = self.curr_rec
+        self.curr_rec = ParmRec()
+        self.frames = None
+        self.state = self.SawData
+
+    def _endPreset( self, value, lineNum ):
+        if self.state != self.SawData:
+            print( "Phase error at line %d. Expected SawData, but was %d." % (lineNum, self.state) )
+            sys.exit( 1 )
+
+        try:
+            endId = int( value )
+        except ValueError:
+            print( "Parse error at line %d. Expecting single integer." % lineNum )
+            sys.exit( 1 )
+
+        if endId != self.id:
+            print( "Parse error at line %d. Preset number mismatch. Expected %d, but saw %d." % (lineNum, self.id, endId) )
+            sys.exit( 1 )
+            
+        self.compile()
+        self.state = self.Done
+
+
+# Synthetic library shaped like real captures: one record per range
+# in ranges.json, plus a memo line and a delay record.
+def make_library( count, seed=1 ):
+    rng = random.Random( seed )
+    scriptdir = os.path.dirname( os.path.abspath(__file__) )
+    with open( scriptdir + '/parameters/ranges.json' ) as fh:
+        ranges = json.load( fh )
+
+    out = io.StringIO()
+    for program in range( count ):
+        out.write( "_preset %d\n" % program )
+        for rec in ranges:
+            first = rec['baseAddr']
+            length = Katana.decode_array( rec['lastAddr'] ) - Katana.decode_array( first ) + 1
+            out.write( "# %s\n" % rec['name'] )
+            out.write( "_addr %s\n" % ' '.join( "%02x" % b for b in first ) )
+            out.write( "_data %s\n" % ' '.join( "%02x" % rng.randrange( 128 ) for i in range( min( length, 241 ) ) ) )
+        out.write( "_addr ff 00 00 00\n_data 32\n" )
+        out.write( "_endPreset %d\n" % program )
+    return out.getvalue()
+
+def timed( func ):
+    start = time.perf_counter()
+    result = func()
+    return result, time.perf_counter() - start
+
+
+if __name__ == '__main__':
+    count = int( sys.argv[1] ) if len( sys.argv ) > 1 else 10000
+
+    text = make_library( count )
+    print( "Library: %d presets, %.1f MB" % (count, len( text ) / 1e6) )
+
+    old, old_time = timed( lambda: list( OriginalPreset.get_from_file( io.StringIO( text ) ) ) )
+
+    parser = PresetParser()
+    new, new_time = timed( lambda: list( parser.parse( io.StringIO( text ) ) ) )
+
+    out = io.StringIO()
+    for obj in new:
+        obj.serialize( out )
+    same = out.getvalue() == text
+
+    # Errors are collected, not fatal
+    damaged = text.replace( "_data 32\n", "_data zz\n", 3 )
+    check = PresetParser()
+    survivors = sum( 1 for obj in check.parse( io.StringIO( damaged ) ) )
+
+    print( "  original parser: %6.2f sec  (%d presets)" % (old_time, len( old )) )
+    print( "  PresetParser:    %6.2f sec  (%d presets, %.1fx)" % (new_time, len( new ), old_time / new_time) )
+    print( "  round trip byte-for-byte: %s" % ("yes" if same else "NO") )
+    print( "  damaged copy: %d presets loaded, %d errors reported" % (survivors, len( check.errors )) )
@@ -0,0 +1,80 @@
+#!/usr/bin/python3
+#
+# Microbenchmark: CPU cost of recalling a preset, comparing the
+# original per-record send path (checksum loop, list rebuild, mido
+# validation on every record) with cached precompiled frames.
+#
+# No MIDI hardware needed; output goes to a null port.
+#
+# Usage: bench_recall.py [iterations]
+#
+
+import os
+import sys
+import time
+
+import mido
+import mido.ports
+
+from globals import *
+from katana import Katana
+from katana_emulator import Emulator
+from bench_bridge import make_library
+from range import Range
+
+class NullOutput( mido.ports.BaseOutput ):
+    def _send( self, msg ):
+        pass
+
+class NullInput( mido.ports.BaseInput ):
+    pass
+
+# The send path as it was before frames were cached
+def original_recall( preset, outport, sysex ):
+    for parm in preset.parms:
+        if parm.addr[0] == 0xff:
+            continue
+        msg = list( parm.addr )
+        msg.extend( parm.data )
+        accum = 0
+        for byte in msg:
+            accum = (accum + byte) & 0x7f
+            cksum = (0x80 - accum) & 0x7f
+        data = []
+        data.extend( SEND_PREFIX )
+        data.extend( msg )
+        data.append( cksum )
+        sysex.data = data
+        outport.send( sysex )
+
+def cpu_time( func, iterations ):
+    start = time.process_time()
+    for i in range( iterations ):
+        func()
+    return (time.process_time() - start) / iterations
+
+
+if __name__ == '__main__':
+    iterations = int( sys.argv[1] ) if len( sys.argv ) > 1 else 200
+
+    scriptdir = os.path.dirname( os.path.abspath(__file__) )
+    emulator = Emulator( scriptdir + '/parameters/' )
+    library = make_library( emulator, Range( scriptdir + '/parameters/ranges.json' ), 2 )
+    preset = library[10]
+
+    # Katana opens its ports by name; hand it null ports instead
+    mido.open_output = lambda *args, **kwargs: NullOutput()
+    mido.open_input = lambda *args, **kwargs: NullInput()
+    katana = Katana( None, 0 )
+
+    old = cpu_time( lambda: original_recall( preset, katana.outport, mido.Message('sysex') ), iterations )
+    build = cpu_time( preset.compile, iterations )
+    full = cpu_time( lambda: preset.transmit( katana, force=True ), iterations )
+    same = cpu_time( lambda: preset.transmit( katana ), iterations )
+
+    print( "Preset: %d records, %d bytes" %
+           (len( preset.parms ), sum( len( parm.data ) for parm in preset.parms )) )
+    print( "  original recall:        %8.1f usec" % (old * 1e6) )
+    print( "  compile (once/capture): %8.1f usec" % (build * 1e6) )
+    print( "  cached recall (forced): %8.1f usec  (%.1fx)" % (full * 1e6, old / full) )
+    print( "  cached recall (no diff):%8.1f usec" % (same * 1e6) )
@@ -0,0 +1,169 @@
+#!/usr/bin/python3
+#
+# Table-driven CC --> sysex mapping.  Mappings are read from a JSON
+# file (parameters/cc_map.json) keyed by CC number:
+#
+#   "70": { "parameter": "globals.VOLUME_PEDAL", "curve": "log" }
+#   "7":  { "parameter": "amplifier.frontPanel.gain",
+#           "curve": "linear", "range": [10, 80], "invert": true }
+#   "11": { "parameter": "amplifier.frontPanel.volume",
+#           "curve": [[0, 0], [64, 30], [127, 100]] }
+#
+# 'parameter' is any name known to ParameterRegistry.  'curve' is
+# 'linear', 'log' (audio taper, as the original volume pedal mapping),
+# 'exp' (its mirror image) or a list of [cc, value] points joined by
+# straight lines.  'range' limits the output of the built-in curves
+# and defaults to the parameter's own range (0..127 if it has none).
+# 'invert' turns the controller around.  Enum and boolean parameters
+# are split into equal bands of the controller's travel.
+#
+# Each mapping is compiled to a 128-entry table of ready-to-send data
+# when loaded, so handling a CC is two list lookups.  reload() rereads
+# the file if it has changed; a broken file is logged and the previous
+# tables kept.
+#
+# Usage: cc_map.py [map_file]   (prints the compiled tables)
+#
+
+import os
+import sys
+import json
+import math
+import syslog
+
+from katana import Katana
+from parameter_registry import ParameterRegistry
+
+# Controller position 0..127 --> fraction of the output range
+
+def linear_curve( value ):
+    return value / 127
+
+def log_curve( value ):
+    frac = (value + 1) / 128
+    scale = (math.exp( frac ) - 1) / (math.e - 1)
+    return value * scale / 127
+
+def exp_curve( value ):
+    return 1 - log_curve( 127 - value )
+
+CURVES = { 'linear': linear_curve, 'log': log_curve, 'exp': exp_curve }
+
+class CCMap:
+
+    def __init__( self, filename, registry ):
+        self.filename = filename
+        self.registry = registry
+        self.mtime = None
+
+        # Indexed by CC number: None or (addr, table), where table[value]
+        # is the data to write for that controller value
+        self.tables = [ None ] * 128
+
+        self.reload()
+
+    # Reread the file if it changed since the last load.  Returns True
+    # if new tables were installed.
+    def reload( self ):
+        try:
+            mtime = os.stat( self.filename ).st_mtime_ns
+        except OSError:
+            mtime = None
+        if mtime == self.mtime:
+            return False
+        self.mtime = mtime
+
+        if mtime == None:
+            self.tables = [ None ] * 128
+            return True
+
+        try:
+            with open( self.filename ) as fh:
+                config = json.load( fh )
+            tables = self.compile( config )
+        except ( OSError, ValueError, KeyError, TypeError ) as e:
+            syslog.syslog( "CC map %s not loaded: %s" % (self.filename, e) )
+            return False
+
+        self.tables = tables
+        syslog.syslog( "CC map %s: %d mappings" % (self.filename, sum( 1 for t in tables if t != None )) )
+        return True
+
+    # Data to write for a CC, as (addr, data), or None if unmapped
+    def lookup( self, control, value ):
+        entry = self.tables[control]
+        if entry == None:
+            return None
+        return ( entry[0], entry[1][value] )
+
+    def compile( self, config ):
+        tables = [ None ] * 128
+        for key, rec in config.items():
+            control = int( key )
+            if control < 0 or control > 127:
+                raise ValueError( "CC %d out of range" % control )
+            tables[control] = self.compile_one( rec )
+        return tables
+
+    def compile_one( self, rec ):
+        name = rec['parameter']
+        parm = self.registry.get( name )
+        if parm == None:
+            raise KeyError( "unknown parameter " + name )
+
+        invert = rec.get( 'invert', False )
+        curve = rec.get( 'curve', 'linear' )
+        positions = range( 127, -1, -1 ) if invert else range( 128 )
+
+        if isinstance( curve, list ):
+            points = sorted( curve )
+            values = [ CCMap.interpolate( points, pos ) for pos in positions ]
+        elif parm.dataType in ('enum', 'boolean') and parm.values != None and 'range' not in rec:
+            shape = CURVES[curve]
+            count = len( parm.values )
+            values = [ parm.values[ min( int( shape( pos ) * count ), count - 1 ) ] for pos in positions ]
+        else:
+            shape = CURVES[curve]
+            lo, hi = rec.get( 'range', CCMap.default_range( parm ) )
+            values = [ int( lo + shape( pos ) * (hi - lo) ) for pos in positions ]
+
+        table = tuple( CCMap.encode( value, parm.size ) for value in values )
+        return ( tuple( Katana.encode_scalar( parm.addr ) ), table )
+
+    @staticmethod
+    def default_range( parm ):
+        if parm.values != None and parm.dataType in ('byteRange', 'centeredByteRange', 'wordRange'):
+            return parm.values[0], parm.values[-1]
+        return 0, 127
+
+    # Piecewise-linear curve through sorted [cc, value] points
+    @staticmethod
+    def interpolate( points, pos ):
+        if pos <= points[0][0]:
+            return int( points[0][1] )
+        for (x0, y0), (x1, y1) in zip( points, points[1:] ):
+            if pos <= x1:
+                return int( round( y0 + (y1 - y0) * (pos - x0) / (x1 - x0) ) )
+        return int( points[-1][1] )
+
+    # Parameter value as sysex data bytes (7 bits per byte, MSB first)
+    @staticmethod
+    def encode( value, size ):
+        data = []
+        for i in range( size ):
+            data.insert( 0, value & 0x7f )
+            value >>= 7
+        return tuple( data )
+
+
+if __name__ == '__main__':
+    scriptdir = os.path.dirname( os.path.abspath(__file__) )
+    datadir = scriptdir + '/parameters/'
+    filename = sys.argv[1] if len( sys.argv ) > 1 else datadir + 'cc_map.json'
+
+    ccmap = CCMap( filename, ParameterRegistry( datadir ) )
+    for control, entry in enumerate( ccmap.tables ):
+        if entry != None:
+            addr, table = entry
+            print( "CC %3d -> %s" % (control, ' '.join( "%02x" % b for b in addr )) )
+            print( "   ", [ data[-1] if len( data ) == 1 else data for data in table ] )
@@ -0,0 +1,90 @@
+# Rate-limited output stage for continuous controllers.  An expression
+# pedal can send far more messages than the amp can absorb, so writes
+# are queued by target (a sysex address, or a pass-through CC number)
+# and only the latest value for each target is kept.  Targets are
+# flushed at most 'per_target' times a second each and 'overall' times
+# a second in total.  The first value after a pause goes out at once
+# and the last value always goes out, so the amp ends up where the
+# pedal came to rest.
+#
+# Runs on the bridge's event loop: submit() from the loop, and run()
+# as a task.
+
+import time
+import asyncio
+from collections import OrderedDict
+
+class Coalescer:
+
+    def __init__( self, per_target=50, overall=200 ):
+        self.target_gap = 1 / per_target
+        self.overall_gap = 1 / overall
+
+        # key -> (func, args) of the latest unsent write, oldest first
+        self.pending = OrderedDict()
+        self.last_sent = {}
+        self.next_send = 0
+        self.wakeup = asyncio.Event()
+
+        # Counters
+        self.submitted = 0
+        self.sent = 0
+        self.coalesced = 0
+
+    # Queue func( *args ) as the latest write for 'key'
+    def submit( self, key, func, *args ):
+        self.submitted += 1
+        if key in self.pending:
+            self.coalesced += 1
+        self.pending[key] = ( func, args )
+        self.wakeup.set()
+
+    # Send whatever the rate limits allow right now.  Returns seconds
+    # until the next write is due, or None if nothing is pending.
+    def flush( self ):
+        while self.pending:
+            now = time.monotonic()
+            if now < self.next_send:
+                return self.next_send - now
+
+            key = None
+            due = None
+            for candidate in self.pending:
+                last = self.last_sent.get( candidate )
+                if last == None or now - last >= self.target_gap:
+                    key = candidate
+                    break
+                ready = last + self.target_gap
+                if due == None or ready < due:
+                    due = ready
+            if key == None:
+                return due - now
+
+            func, args = self.pending.pop( key )
+            func( *args )
+            self.last_sent[key] = now
+            self.next_send = now + self.overall_gap
+            self.sent += 1
+        return None
+
+    async def run( self ):
+        while True:
+            self.wakeup.clear()
+            delay = self.flush()
+            if delay == None:
+                await self.wakeup.wait()
+            else:
+                try:
+                    await asyncio.wait_for( self.wakeup.wait(), delay )
+                except asyncio.TimeoutError:
+                    pass
+
+    # Send everything still pending, ignoring the limits (shutdown)
+    def drain( self ):
+        while self.pending:
+            key, ( func, args ) = self.pending.popitem( last=False )
+            func( *args )
+            self.sent += 1
+
+    def summary( self ):
+        return "%d received, %d sent, %d coalesced" % (self.submitted, self.sent, self.coalesced)
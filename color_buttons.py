@@ -57,18 +57,23 @@ class ColorButtons:
         self.simple = parms['dspSimple']
         self.complex = parms['dspComplex']
         
+    # Each scan below reads the small state blocks it needs in a
+    # single batch and decodes them locally, rather than making one
+    # round trip per byte.
+
     # Scans amplifier state for DSP knobs and returns ordered array of
     # metadata records.
     #
     def read_knobs( self, katana ):
         offsets = self.knob_state['knobOffset']
-        knob_base_addr = self.knob_state['baseAddr']
-        assign_base_addr = self.assign_index['baseAddr']
+        ( knob_block, assign_block ) = katana.query_sysex_blocks(
+            [ ( self.knob_state['baseAddr'], self.knob_state['length'] ),
+              ( self.assign_index['baseAddr'], self.assign_index['length'] ) ] )
         result = []
         
         for knob in self.knobs:
-            # Read enumeration value for knob state
-            state = katana.query_sysex_byte( knob_base_addr, offsets[knob] )
+            # Enumeration value for knob state
+            state = knob_block[ offsets[knob] ]
 
             # Lookup range (A/B) and color
             ( range, color ) = self.knob_state_xlate[state]
@@ -80,25 +85,26 @@ class ColorButtons:
             # Lookup group (simple/complex) and category (boost, delay, etc)
             rec = self.assign_index['knob'][knob]['range'][range]
 
-            # Read enumeration value for active class (complex) or model (simple) 
-            type = katana.query_sysex_byte( assign_base_addr, rec['colorOffset'][color] )
+            # Enumeration value for active class (complex) or model (simple) 
+            type = assign_block[ rec['colorOffset'][color] ]
             result.append( {"group":rec['group'], "category":rec['category'], "type":type} )
 
         return result
 
     def read_color_assign( self, katana ):
-        assign_base_addr = self.assign_index['baseAddr']
-        active_base_addr = self.active_index['baseAddr']
+        ( active_block, assign_block ) = katana.query_sysex_blocks(
+            [ ( self.active_index['baseAddr'], self.active_index['length'] ),
+              ( self.assign_index['baseAddr'], self.assign_index['length'] ) ] )
         result = []
 
         # First, scan assigned simple devices. Since all three colors share the
         # same set of parameters, we do only the currently active color.
         offsets = self.active_index['categoryOffset']
         for category in self.simple:
-            color_enum = katana.query_sysex_byte( active_base_addr, offsets[category] )
+            color_enum = active_block[ offsets[category] ]
             color = self.enum2name[color_enum]
             idx = self.assign_index2[category][color]
-            type = katana.query_sysex_byte( assign_base_addr, idx )
+            type = assign_block[idx]
             result.append( {"group":"simple", "category":category, "type":type} )
 
         # Complex devices have distinct parameter address ranges, so do all
@@ -106,7 +112,7 @@ class ColorButtons:
         for category in self.complex:
             for color in self.name2enum.keys():
                 idx = self.assign_index2[category][color]
-                type = katana.query_sysex_byte( assign_base_addr, idx )
+                type = assign_block[idx]
                 result.append( {"group":"complex", "category":category, "type":type} )
 
         return result
@@ -0,0 +1,61 @@
+# On-disk cache for things the bridge derives from files at startup
+# (compiled parameter metadata, capture plans, parsed preset
+# libraries).  Each entry is keyed by the path, mtime and size of every
+# source it was built from, so editing or replacing a source simply
+# rebuilds the entry.  Cache problems are never fatal: a missing or
+# unreadable entry is rebuilt and a failed write is only logged.
+
+import os
+import pwd
+import pickle
+import syslog
+
+# In the home directory of the user we run as.  The launcher drops
+# privileges without a login, so $HOME may still be root's.
+CACHE_DIR = os.path.join( pwd.getpwuid( os.getuid() ).pw_dir, '.cache', 'katana-bridge' )
+
+def cache_path( name ):
+    return os.path.join( CACHE_DIR, name )
+
+# Identity of a set of source files.  Missing files are part of the key
+# too, so creating one invalidates the entry.
+def source_key( sources ):
+    key = []
+    for path in sources:
+        try:
+            st = os.stat( path )
+            key.append( (os.path.abspath( path ), st.st_mtime_ns, st.st_size) )
+        except OSError:
+            key.append( (os.path.abspath( path ), None, None) )
+    return tuple( key )
+
+# Cached value for 'name', or None if absent or stale
+def load( name, sources, version=1 ):
+    try:
+        with open( cache_path( name ), 'rb' ) as fh:
+            key, value = pickle.load( fh )
+    except Exception:
+        return None
+    if key != ( version, source_key( sources ) ):
+        return None
+    return value
+
+def store( name, sources, value, version=1 ):
+    filename = cache_path( name )
+    tmpfile = filename + ".tmp"
+    try:
+        os.makedirs( CACHE_DIR, exist_ok=True )
+        with open( tmpfile, 'wb' ) as fh:
+            pickle.dump( (( version, source_key( sources ) ), value), fh,
+                         protocol=pickle.HIGHEST_PROTOCOL )
+        os.replace( tmpfile, filename )
+    except OSError as e:
+        syslog.syslog( "Cannot write cache %s: %s" % (filename, e) )
+
+# Return the cached value, building (and caching) it if needed
+def cached( name, sources, build, version=1 ):
+    value = load( name, sources, version )
+    if value == None:
+        value = build()
+        store( name, sources, value, version )
+    return value
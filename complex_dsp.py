@@ -33,7 +33,13 @@ class ComplexDSP:
     #
     # Returns class name and parameter block descriptor
     #
-    def get_coords( self, category, class_enum ):
+    def get_coords( self, category, class_enum=None ):
+        # Also accepts a record from ColorButtons.read_knobs() or
+        # read_color_assign() as the only argument
+        if isinstance( category, dict ):
+            class_enum = category['type']
+            category = category['category']
+
         # Lookup class name (T-Wah, Octave, ParametricEQ, etc)
         name = self.enum2name[class_enum]
 
@@ -75,5 +81,5 @@ if __name__ == '__main__':
     
     for dsp_rec in dsp_recs:
         if dsp_rec['group'] == 'complex':
-            coords = complexObj.get_coords( dsp_rec['category'], dsp_rec['type'] ) 
+            coords = complexObj.get_coords( dsp_rec ) 
             print( "Name: ", coords['name'], ", Blocks: ", coords['blocks'] )
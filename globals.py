@@ -15,3 +15,11 @@ CURRENT_PRESET_ADDR = ( 0x00, 0x01, 0x00, 0x00 )
 CURRENT_PRESET_LEN = 0x02
 
 VOLUME_PEDAL_ADDR = ( 0x60, 0x00, 0x06, 0x33 )
+
+# Largest data payload the amp sends (and safely accepts) in a single
+# DT1 message
+MAX_CHUNK = 241
+
+# Framing bytes in a DT1 message (F0, 7-byte prefix, 4-byte address,
+# checksum, F7)
+FRAME_OVERHEAD = 14
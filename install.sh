@@ -38,6 +38,10 @@ cp -f *.py $LIBDIR
 [ -d $PARMDIR ] || mkdir -p $PARMDIR
 cp -f ./parameters/*.json $PARMDIR
 
+# The sysex spec is read to plan capture ranges
+[ -d $LIBDIR/doc ] || mkdir -p $LIBDIR/doc
+cp -f ./doc/katana_sysex.txt $LIBDIR/doc
+
 chown -R root:root $LIBDIR/*
 
 echo "Copy init script to $INITDIR and register"
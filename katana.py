@@ -2,91 +2,156 @@
 import mido
 import time
 from time import sleep
-import threading
-import sys
+from bisect import bisect_right
 from globals import *
 import syslog
+from shadow import ShadowImage
+from write_planner import WritePlanner
+from query_engine import Query, QueryEngine
+from paced_sender import PacedSender
+import metrics
+import traffic_log
 
 class Katana:
 
-    def __init__( self, portname, channel, clear_input=False ):
+    # How long (seconds) the read cache trusts a byte, by region
+    # start address.  Knobs change the panel and patch areas behind our
+    # back, and the panel's channel buttons change the current preset,
+    # so those are trusted only briefly; system settings rarely change.
+    CACHE_TTL = ( ( (0x00, 0x00, 0x00, 0x00), 10.0 ),
+                  ( (0x00, 0x00, 0x04, 0x00), 0.5 ),
+                  ( (0x00, 0x00, 0x05, 0x00), 10.0 ),
+                  ( CURRENT_PRESET_ADDR, 0.5 ),
+                  ( (0x00, 0x01, 0x00, CURRENT_PRESET_LEN), 10.0 ),
+                  ( (0x60, 0x00, 0x00, 0x00), 2.0 ) )
+
+    def __init__( self, portname, channel, clear_input=False, drain_gap=0.08, query_window=4,
+                  byte_rate=None, frame_gap=0.0, cache_reads=True ):
         self.outport = mido.open_output( portname )
         self.inport = mido.open_input( portname )
 
-        self.sysex = mido.Message('sysex')
+        # Everything we send is paced through one thread, see
+        # paced_sender.py.  'byte_rate' (bytes/sec) and 'frame_gap'
+        # (seconds) shape the traffic; None and 0 mean no limit.
+        self.sender = PacedSender( self.outport, rate=byte_rate, gap=frame_gap )
 
+        # Templates only; sends copy them since they may come from
+        # more than one thread.
         self.pc = mido.Message('program_change')
         self.pc.channel = channel
 
         self.cc = mido.Message('control_change')
         self.cc.channel = channel
 
-        self.chunk_count = 0
-        
-        # Thread synchronization around incoming MIDI data. Used only
-        # in the case where a single message is expected.  We need to use
-        # a different approach for bulk sysex dumps where an arbitrary 
-        # number of replies may be sent.
-        self.receive_cond = threading.Condition()
-        self.addr = []
-        self.data = []
+        # Outstanding queries.  Replies are matched to requests by
+        # address span, so several queries may be in flight at once.
+        self.queries = QueryEngine( self._send_query, window=query_window )
+
+        # What we believe the amp's memory holds, updated by every
+        # write and every read reply.
+        self.shadow = ShadowImage()
+
+        # Reads are answered from the shadow while its bytes are
+        # fresh.  Set cache_reads False (or pass bypass=True to a
+        # query) for authoritative reads from the amp.
+        self.cache_reads = cache_reads
+        self.ttl_starts = [ Katana.decode_array( addr ) for addr, ttl in Katana.CACHE_TTL ]
+        self.ttls = [ ttl for addr, ttl in Katana.CACHE_TTL ]
+        self.cache_hits = 0
+        self.cache_misses = 0
+
+        # All batched writes are merged/split through this
+        self.planner = WritePlanner()
 
         if clear_input: 
-            self._clear_input()
+            self._clear_input( idle_gap=drain_gap )
 
         # Since mido callbacks take only a single parameter, bind
         # the current object into a closure
         self.inport.callback = lambda msg: self._post( msg )
 
-    # Drain incoming USB buffer by doing polled reads over
-    # five seconds
-    def _clear_input( self ):
+    # Drain stale messages from the incoming USB buffer. Stops once
+    # the port has been quiet for 'idle_gap' seconds (or after
+    # 'max_time' if the amp keeps talking).  Sleeps between polls
+    # rather than spinning. Returns the number of messages discarded.
+    def _clear_input( self, idle_gap=0.08, max_time=2.0, poll_interval=0.005 ):
         # Force off edit mode
         # self.send_sysex_data( EDIT_OFF )
+        discarded = 0
         start = time.time()
+        last_seen = start
         while True:
             msg = self.inport.poll()
             now = time.time()
-            if now - start > 5:
+            if msg is not None:
+                discarded += 1
+                last_seen = now
+                continue
+
+            if now - last_seen >= idle_gap or now - start >= max_time:
                 break
+            sleep( poll_interval )
 
-    # Called by rtmidi in a separate thread to absorb bulk response
+        if discarded:
+            syslog.syslog( "Discarded %d stale messages from amp" % discarded )
+        return discarded
+
+    # Called by rtmidi in a separate thread to absorb query replies
     def _post( self, msg ):
+        traffic_log.record( traffic_log.IN, traffic_log.AMP, msg )
+        metrics.count( 'amp_in.' + msg.type )
         if msg.type != 'sysex':
             syslog.syslog( "Err: Saw msg type: " + msg.type )
-
-        self.receive_cond.acquire()
+            return
+        metrics.count( 'amp_in.sysex_bytes', len( msg.data ) + 2 )
 
         curr_addr = msg.data[7:11]
-        self.addr.append( curr_addr )
-
         curr_data = msg.data[11:-1]
-        self.data.append( curr_data )
 
-        # Signal the consumer if we've reached the expected number of messages.
-        self.chunk_count += 1
-        if self.chunk_count == self.target_count:
-            self.chunk_count = 0
-            self.receive_cond.notify()
+        # Hand the chunk to the query that asked for it.  Late or
+        # unsolicited replies are quarantined by the engine.
+        start = Katana.decode_array( curr_addr )
+        if self.queries.dispatch( start, curr_addr, curr_data ) != None:
+            self.shadow.update( start, curr_data )
 
-        self.receive_cond.release()
+    # Put a query's RQ1 on the wire
+    def _send_query( self, query ):
+        msg = Katana.encode_scalar( query.span[0] )
+        msg.extend( Katana.encode_scalar( query.length() ) )
+        self._send( QUERY_PREFIX, msg )
+
+    # Roland checksum over address + data bytes: the 7-bit two's
+    # complement of their sum.
+    @staticmethod
+    def checksum( body ):
+        return (0x80 - (sum( body ) & 0x7f)) & 0x7f
 
     # Concatenate caller's prefix and message, add checksum and send
     # as sysex message. Handles both store and query commands.
     def _send( self, prefix, msg ):
         # print( "DEBUG: msg = ", msg )
-        # Calculate Roland cksum on msg only
-        accum = 0
-        for byte in msg:
-            accum = (accum + byte) & 0x7f
-            cksum = (0x80 - accum) & 0x7f
-
-        data = []
-        data.extend( prefix )
+        data = list( prefix )
         data.extend( msg )
-        data.append( cksum )
-        self.sysex.data = data
-        self.outport.send( self.sysex )
+        data.append( Katana.checksum( msg ) )
+        self.sender.send( mido.Message( 'sysex', data=data ) )
+
+    # Build a ready-to-send DT1 message for address + data. Meant to be
+    # done once and cached, so that checksumming and mido's per-byte
+    # validation are not repeated on every send.
+    @staticmethod
+    def make_frame( addr, data ):
+        body = list( addr )
+        body.extend( data )
+        frame = list( SEND_PREFIX )
+        frame.extend( body )
+        frame.append( Katana.checksum( body ) )
+        return mido.Message( 'sysex', data=frame )
+
+    # Send a frame built by make_frame(). Caller passes the scalar
+    # start address and data it carries so the shadow stays current.
+    def send_frame( self, frame, start, data ):
+        self.sender.send( frame )
+        self.shadow.update( start, data )
 
     # Convenience method for store commands. Takes address and
     # optional data payload.
@@ -98,6 +163,48 @@ class Katana:
             msg.extend( data )
 
         self._send( SEND_PREFIX, msg )
+        self.shadow.update( Katana.decode_array( msg[0:4] ), msg[4:] )
+
+    # Send a batch of (addr, data) writes through the write planner,
+    # which merges adjacent writes and splits oversized ones. Records
+    # whose address begins with 0xff are delays (data[0] is msec) and
+    # act as ordering barriers.  With 'diff' set, only bytes that
+    # differ from the shadow image are sent.  Returns the number of
+    # messages sent.
+    def send_writes( self, writes, diff=False ):
+        items = []
+        for addr, data in writes:
+            if addr[0] == 0xff:
+                items.append( (None, data[0]) )
+            else:
+                items.append( (Katana.decode_array( addr ), data) )
+
+        filter = self.shadow.diff if diff else None
+
+        count = 0
+        for start, data in self.planner.plan( items, filter ):
+            if start == None:
+                sleep( data/1000 )
+            else:
+                self.send_sysex_data( Katana.encode_scalar( start ), data )
+                count += 1
+        return count
+
+    # Block until everything queued for the amp has been sent
+    def flush( self ):
+        self.sender.wait_idle()
+
+    # Read back a batch of (addr, data) writes.  Writes are first folded
+    # into the final image they leave behind, so a value that a later
+    # write replaced (e.g. a mute before the volume is restored) is not
+    # expected.  Returns the start addresses of blocks whose contents
+    # differ from that image.
+    def verify_writes( self, writes ):
+        blocks = WritePlanner.merge( [ (Katana.decode_array( addr ), data)
+                                       for addr, data in writes if addr[0] != 0xff ] )
+        blocks = [ (Katana.encode_scalar( start ), data) for start, data in blocks ]
+        readback = self.query_sysex_blocks( [ (addr, len( data )) for addr, data in blocks ], bypass=True )
+        return [ addr for (addr, data), got in zip( blocks, readback ) if data != got ]
 
     # Encode scalar length into 4-byte sysex value
     @staticmethod
@@ -113,72 +220,112 @@ class Katana:
     def decode_array( ary ):
         return (ary[0] * 0x200000) + (ary[1] * 0x4000) + (ary[2] * 0x80) + ary[3]
     
-    # Next (3) query methods return a two-element tuple in the general form:
+    # Query methods return a two-element tuple in the general form:
     # [addrA, addrB, .. ], [ [dataA, .. ], [dataB, .. ], .. ]
 
     # For situations where we do not know the number of replies to be
-    # expected. It appears that 5 seconds is enough time for Katana to
-    # send a complete MIDI sysex dump.  Warning: If more data arrives 
-    # after the timeout it will cause big problems when we attempt to
-    # snapshot a preset.
-    def get_bulk_sysex_data( self, msg, timeout=5 ):
-        self.data = []
-        self.addr = []
-
-        self.target_count = 99
-        self._send( QUERY_PREFIX, msg )
-        sleep( timeout )
-        return self.addr, self.data
+    # expected.  Message is start address followed by 4-byte length.
+    # The dump is considered complete as soon as any of these occur:
+    #
+    #  - a chunk reaches the end of the requested span
+    #  - 'expected_bytes' (if given) have arrived
+    #  - no chunk has arrived for 'idle_gap' seconds after the first
+    #
+    # If nothing arrives at all we give up after 'timeout' seconds.
+    # Chunks that trickle in afterwards are quarantined as strays.
+    def get_bulk_sysex_data( self, msg, timeout=5, idle_gap=0.25, expected_bytes=None ):
+        query = Query( Katana.decode_array( msg[0:4] ), Katana.decode_array( msg[4:8] ),
+                       expected_bytes=expected_bytes, timeout=timeout )
+        self.queries.submit( query )
+        return self.queries.wait( query, idle_gap=idle_gap )
+
+    # Run queries, answering those the shadow holds fresh data for
+    # without going to the amp.  Results are in the engine's (addr,
+    # data) chunk-list form.
+    def _run_queries( self, queries, bypass=False ):
+        if bypass or not self.cache_reads:
+            return self.queries.run( queries )
+
+        results = []
+        misses = []
+        for query in queries:
+            start = query.span[0]
+            i = bisect_right( self.ttl_starts, start ) - 1
+            data = None
+            if i >= 0:
+                data = self.shadow.fresh( start, query.length(), self.ttls[i] )
+            if data == None:
+                misses.append( query )
+                results.append( None )
+                continue
+
+            addr = []
+            chunks = []
+            for pos in range( 0, len( data ), MAX_CHUNK ):
+                addr.append( tuple( Katana.encode_scalar( start + pos ) ) )
+                chunks.append( data[pos:pos + MAX_CHUNK] )
+            results.append( (addr, chunks) )
+
+        self.cache_hits += len( queries ) - len( misses )
+        self.cache_misses += len( misses )
+        metrics.count( 'cache.hits', len( queries ) - len( misses ) )
+        metrics.count( 'cache.misses', len( misses ) )
+        if misses:
+            fetched = iter( self.queries.run( misses ) )
+            results = [ next( fetched ) if result == None else result for result in results ]
+        return results
 
     # Request sysex data by passing start address and length. This
     # method is generally for smaller, single-chunk messages.
-    def query_sysex_data( self, addr, len ):
-        self.receive_cond.acquire()
-
-        self.data = []
-        self.addr = []
-        msg = list( addr )
-        msg.extend( Katana.encode_scalar(len) )
-
-        self.target_count = (len // 241) + 1
-        self._send( QUERY_PREFIX, msg )
-
-        result = self.receive_cond.wait(5)
-        if not result:
-            syslog.syslog( "Error: Timeout on cond wait" )
-
-        self.receive_cond.release()
-
-        return self.addr, self.data
+    def query_sysex_data( self, addr, len, bypass=False ):
+        return self._run_queries( [ Katana.data_query( addr, len ) ], bypass )[0]
 
     # Request sysex data (possibly requiring multiple chunks) by
     # passing first and last address of desired range. It is the
     # caller's responsibility to ensure the total response does not
     # span address discontinuities.  If that occurs the chunk count is
     # likely to be over-estimated and the operation will timeout.
-    def query_sysex_range( self, first_addr, last_addr ):
-        self.receive_cond.acquire()
-
-        span = Katana.decode_array(last_addr) - Katana.decode_array(first_addr)
-        offset = Katana.encode_scalar( span + 1 )
-        
-        self.data = []
-        self.addr = []
-
-        msg = list( first_addr )
-        msg.extend( offset )
-
-        # Calculate expected number of chunks.  Maximum chunk is 255 bytes
-        # with max payload of 241 data bytes/
-        self.target_count = ((span + 1) // 241) + 1
-        self._send( QUERY_PREFIX, msg )
-        result = self.receive_cond.wait(5)
-        if not result:
-            syslog.syslog( "Error: Timeout on cond wait" )
-
-        self.receive_cond.release()
-
-        return self.addr, self.data
+    def query_sysex_range( self, first_addr, last_addr, bypass=False ):
+        return self._run_queries( [ Katana.range_query( first_addr, last_addr ) ], bypass )[0]
+
+    # Pipelined form of query_sysex_range().  Takes a list of
+    # (first_addr, last_addr) or (first_addr, last_addr, chunks) tuples
+    # and keeps up to 'query_window' of them in flight.  Returns one
+    # (addr, data) tuple per range.
+    def query_sysex_ranges( self, ranges, bypass=False ):
+        return self._run_queries( [ Katana.range_query( *rec ) for rec in ranges ], bypass )
+
+    # Read several small blocks, given as (addr, length) pairs, in one
+    # pipelined batch.  Returns the bytes of each block as a flat list
+    # (short if the amp did not answer in full).
+    def query_sysex_blocks( self, blocks, bypass=False ):
+        results = self._run_queries( [ Katana.data_query( addr, length ) for addr, length in blocks ], bypass )
+        flat = []
+        for addr, data in results:
+            block = []
+            for chunk in data:
+                block.extend( chunk )
+            flat.append( block )
+        return flat
+
+    # Query for 'len' bytes at addr
+    @staticmethod
+    def data_query( addr, len ):
+        return Query( Katana.decode_array( addr ), len, target_count=(len // MAX_CHUNK) + 1 )
+
+    # Query for first_addr..last_addr inclusive.  Maximum chunk is 255
+    # bytes with max payload of 241 data bytes.  Pass 'chunks' when the
+    # reply size has been planned from the memory model (see
+    # QueryPlanner).  The amp may define bytes the model does not, so
+    # the planned count is only a lower bound: the query still runs to
+    # the end of the span, or until replies pause after that many
+    # chunks.
+    @staticmethod
+    def range_query( first_addr, last_addr, chunks=None ):
+        span = Katana.decode_array( last_addr ) - Katana.decode_array( first_addr )
+        if chunks == None:
+            return Katana.data_query( first_addr, span + 1 )
+        return Query( Katana.decode_array( first_addr ), span + 1, min_count=chunks, idle_gap=0.25 )
 
     # Bias 4-byte sysex array by scalar value
     @staticmethod
@@ -186,47 +333,62 @@ class Katana:
         base_scalar = Katana.decode_array( base )
         return Katana.encode_scalar( base_scalar + offset )
         
-    # Request a single byte
-    def query_sysex_byte( self, addr, offset=None ):
+    # Request a single byte.  Returns None if the amp did not answer.
+    def query_sysex_byte( self, addr, offset=None, bypass=False ):
         if offset == None:
             eff = addr
         else:
             eff = Katana.effective_addr( addr, offset )
 
-        (dummy, data) = self.query_sysex_data( eff, 1 )
+        (dummy, data) = self.query_sysex_data( eff, 1, bypass )
+        if not data or not data[0]:
+            # Timed out (logged by the query engine)
+            return None
         return data[0][0]
         
     # Send program change
     def send_pc( self, program ):
-        self.pc.program = program
-        self.outport.send( self.pc )
+        self.sender.send( self.pc.copy( program=program ) )
+
+        # Amp has loaded a different patch; our shadow is now stale.
+        self.shadow.clear()
 
     # Send control change
     def send_cc( self, control, value ):
-        self.cc.control = control
-        self.cc.value = value
-        self.outport.send( self.cc )
+        self.sender.send( self.cc.copy( control=control, value=value ) )
+
+        # The amp may act on the CC in ways we cannot track
+        self.shadow.expire()
 
     # Convenience method to set amplifier volume
     def volume( self, value ):
-        self.send_sysex_data( VOLUME_PEDAL_ADDR, (value,) )
+        self.send_writes( [ (VOLUME_PEDAL_ADDR, (value,)) ] )
 
     # Cycle volume pedal gain to provide audible signal
     def signal( self ):
         # Get current volume pedal position
         current_volume = self.query_sysex_byte( VOLUME_PEDAL_ADDR )
+        if current_volume == None:
+            return
+
+        for delay in self.signal_steps( current_volume ):
+            sleep( delay )
 
+    # Generator form of signal(), for callers that already know the
+    # pedal position.  Performs each write and yields the pause (in
+    # seconds) before the next.
+    def signal_steps( self, current_volume ):
         # Mute volume briefly
-        self.send_sysex_data( VOLUME_PEDAL_ADDR, (0,)  )
-        sleep( 0.3 )
-        
+        self.volume( 0 )
+        yield 0.3
+
         # Then cycle to 50% in case volume pedal was off when
         # save initiated.
-        self.send_sysex_data( VOLUME_PEDAL_ADDR, (50,) )
-        sleep( 0.3 )
+        self.volume( 50 )
+        yield 0.3
 
         # Finally, restore current pedal position
-        self.send_sysex_data( VOLUME_PEDAL_ADDR, (current_volume,) )
+        self.volume( current_volume )
 
 
 if __name__ == '__main__':
@@ -0,0 +1,171 @@
+#!/usr/bin/python3
+#
+# Software stand-in for the Katana amplifier.  Opens a pair of mido
+# virtual ports that look like the amp's USB MIDI interface and
+# answers sysex queries from a byte-addressed memory image, so the
+# bridge can be exercised and timed without hardware.
+#
+# Usage: katana_emulator.py [--port NAME] [--latency SEC] [--jitter SEC]
+#
+# Then point the bridge (or katana_convert, range.py, etc) at port
+# "KATANA:KATANA MIDI 1".
+#
+
+import os
+import time
+import queue
+import random
+import threading
+import syslog
+
+from globals import *
+from katana import Katana
+from memory_image import MemoryImage
+
+class Emulator:
+
+    def __init__( self, datadir, docfile=None, latency=0.0, jitter=0.0,
+                  chunk_size=MAX_CHUNK ):
+        self.image = MemoryImage()
+        if docfile != None:
+            self.image.load_doc( docfile )
+        self.image.load_parameters( datadir )
+
+        # Per-chunk reply delay, randomized by +/- jitter
+        self.latency = latency
+        self.jitter = jitter
+        self.chunk_size = chunk_size
+
+        self.stats = { 'rq1':0, 'dt1':0, 'pc':0, 'cc':0, 'bad_cksum':0,
+                       'chunks_out':0, 'bytes_out':0 }
+
+        self.inport = None
+        self.outport = None
+        self.replies = queue.Queue()
+        self.worker = None
+
+        # Optional observer, called with every incoming message before
+        # it is processed (used by the benchmark harness).
+        self.monitor = None
+
+    # Open virtual ports.  Both share a client and port name so the
+    # Katana class can open them by a single name.
+    def open( self, client='KATANA', portname='KATANA MIDI 1' ):
+        import mido
+        mido.set_backend( 'mido.backends.rtmidi' )
+
+        self.outport = mido.open_output( portname, client_name=client )
+        self.inport = mido.open_input( portname, client_name=client,
+                                       callback=self.handle )
+
+        self.worker = threading.Thread( target=self._reply_loop, daemon=True )
+        self.worker.start()
+
+    def close( self ):
+        if self.worker != None:
+            self.replies.put( None )
+            self.worker.join()
+            self.worker = None
+        if self.inport != None:
+            self.inport.close()
+        if self.outport != None:
+            self.outport.close()
+
+    # Called by rtmidi for every incoming message. Writes are applied
+    # immediately; queries are handed to the reply thread so that
+    # simulated latency does not stall the input callback.
+    def handle( self, msg ):
+        if self.monitor != None:
+            self.monitor( msg )
+
+        if msg.type == 'program_change':
+            self.stats['pc'] += 1
+            return
+        if msg.type == 'control_change':
+            self.stats['cc'] += 1
+            return
+        if msg.type != 'sysex':
+            return
+
+        data = msg.data
+        if len( data ) < 12 or tuple( data[0:6] ) != SEND_PREFIX[0:6]:
+            return
+
+        body = data[7:-1]
+        if Katana.checksum( body ) != data[-1]:
+            self.stats['bad_cksum'] += 1
+            syslog.syslog( "Emulator: bad checksum on incoming sysex" )
+            return
+
+        command = data[6]
+        addr = body[0:4]
+        if command == QUERY_PREFIX[6]:
+            self.stats['rq1'] += 1
+            self.replies.put( (addr, Katana.decode_array( body[4:8] )) )
+        elif command == SEND_PREFIX[6]:
+            self.stats['dt1'] += 1
+            self.image.write( addr, body[4:] )
+
+    # Build DT1 frames for a query, without sending them
+    def answer( self, addr, length ):
+        frames = []
+        for chunk_addr, chunk in self.image.read( addr, length, self.chunk_size ):
+            body = list( chunk_addr ) + chunk
+            frames.append( list( SEND_PREFIX ) + body + [ Katana.checksum( body ) ] )
+        return frames
+
+    def _delay( self ):
+        delay = self.latency
+        if self.jitter > 0:
+            delay += random.uniform( -self.jitter, self.jitter )
+        if delay > 0:
+            time.sleep( delay )
+
+    def _reply_loop( self ):
+        import mido
+        reply = mido.Message( 'sysex' )
+        while True:
+            item = self.replies.get()
+            if item == None:
+                break
+
+            addr, length = item
+            for frame in self.answer( addr, length ):
+                self._delay()
+                reply.data = frame
+                self.outport.send( reply )
+                self.stats['chunks_out'] += 1
+                self.stats['bytes_out'] += len( frame ) + 2
+
+
+if __name__ == '__main__':
+    import argparse
+
+    scriptdir = os.path.dirname( os.path.abspath(__file__) )
+
+    parser = argparse.ArgumentParser( description="Katana amplifier emulator" )
+    parser.add_argument( '--client', default='KATANA' )
+    parser.add_argument( '--port', default='KATANA MIDI 1' )
+    parser.add_argument( '--datadir', default=scriptdir + '/parameters/' )
+    parser.add_argument( '--doc', default=scriptdir + '/doc/katana_sysex.txt' )
+    parser.add_argument( '--latency', type=float, default=0.0,
+                         help="Seconds of delay before each reply chunk" )
+    parser.add_argument( '--jitter', type=float, default=0.0,
+                         help="Random +/- variation applied to latency" )
+    args = parser.parse_args()
+
+    doc = args.doc if os.path.isfile( args.doc ) else None
+    emulator = Emulator( args.datadir, doc, args.latency, args.jitter )
+    emulator.open( args.client, args.port )
+
+    print( "Emulating Katana on %s:%s (%d bytes defined)" %
+           (args.client, args.port, len( emulator.image.mem )) )
+
+    try:
+        while True:
+            time.sleep( 10 )
+    except KeyboardInterrupt:
+        pass
+
+    emulator.close()
+    print( emulator.stats )
@@ -0,0 +1,162 @@
+# Model of the amp's parameter memory, built from the reverse-engineered
+# sysex doc and the parameter metadata.  The emulator serves reads and
+# writes from it, and the query planner uses it as the map of which
+# addresses exist.
+
+import os
+import re
+import json
+from bisect import bisect_left
+
+from globals import MAX_CHUNK
+from katana import Katana
+
+# Sparse image of the amp's parameter memory.  Only addresses we know
+# to exist are 'defined'. Queries that span undefined addresses skip
+# over them, which is what the real amp does.
+class MemoryImage:
+
+    hexrx = re.compile( r'^[0-9A-Fa-f]{2}$' )
+    docrx = re.compile( r'^([0-9A-F]{2}) ([0-9A-F]{2}) ([0-9A-F]{2}) ([0-9A-F]{2}) *-->(.*)$' )
+
+    def __init__( self ):
+        self.mem = {}
+        self.sorted_addrs = None
+
+    # Create (or overwrite) a defined block of memory
+    def define( self, addr, length, fill=0 ):
+        base = Katana.decode_array( addr )
+        for i in range( length ):
+            if base + i not in self.mem:
+                self.mem[ base + i ] = fill
+        self.sorted_addrs = None
+
+    def is_defined( self, addr ):
+        return Katana.decode_array( addr ) in self.mem
+
+    # Store bytes at an address.  Writes to undefined memory are
+    # silently dropped, as they are on the amp.
+    def write( self, addr, data ):
+        base = Katana.decode_array( addr )
+        for i, byte in enumerate( data ):
+            if base + i in self.mem:
+                self.mem[ base + i ] = byte & 0x7f
+
+    # Force bytes into memory, defining addresses as needed (used for
+    # seeding default values).
+    def seed( self, addr, data ):
+        base = Katana.decode_array( addr )
+        for i, byte in enumerate( data ):
+            self.mem[ base + i ] = byte & 0x7f
+        self.sorted_addrs = None
+
+    # Return list of (addr, [data]) replies for a read of 'length'
+    # bytes starting at addr.  Each contiguous run of defined memory is
+    # split into chunks of at most 'chunk_size' bytes.
+    def read( self, addr, length, chunk_size=MAX_CHUNK ):
+        if self.sorted_addrs == None:
+            self.sorted_addrs = sorted( self.mem.keys() )
+
+        first = Katana.decode_array( addr )
+        last = first + length
+
+        replies = []
+        run_start = None
+        run = []
+        prev = None
+        for scalar in self._addrs_between( first, last ):
+            if run and (scalar != prev + 1 or len( run ) == chunk_size):
+                replies.append( (Katana.encode_scalar( run_start ), run) )
+                run = []
+            if not run:
+                run_start = scalar
+            run.append( self.mem[scalar] )
+            prev = scalar
+
+        if run:
+            replies.append( (Katana.encode_scalar( run_start ), run) )
+
+        return replies
+
+    def _addrs_between( self, first, last ):
+        i = bisect_left( self.sorted_addrs, first )
+        while i < len( self.sorted_addrs ) and self.sorted_addrs[i] < last:
+            yield self.sorted_addrs[i]
+            i += 1
+
+    # Seed from the reverse-engineered spec.  Lines look like:
+    #
+    #   60 00 00 31 --> 00 .. 64
+    #   60 00 00 00 --> 4B 41 54 41 ..
+    #
+    # A range ('..') or list (',') gives a single byte whose value is
+    # the first entry.  Placeholders ('xx', 'yy' ..) seed as zero.
+    def load_doc( self, docfile ):
+        with open( docfile ) as fh:
+            for line in fh:
+                match = self.docrx.match( line.strip() )
+                if not match:
+                    continue
+
+                addr = [ int(match.group(i), 16) for i in range(1, 5) ]
+                values = []
+                for token in match.group(5).split():
+                    bare = token.rstrip( ',' )
+                    if self.hexrx.match( bare ):
+                        values.append( int(bare, 16) )
+                    elif bare in ('xx', 'yy', 'cc', 'cr'):
+                        values.append( 0 )
+                    else:
+                        break
+                    if token != bare:
+                        break
+
+                if values:
+                    self.seed( addr, values )
+
+    # Seed from the parameter metadata.  Every block with a base
+    # address and length is defined, and each parameter is given a
+    # sensible default value.
+    def load_parameters( self, datadir ):
+        with open( os.path.join(datadir, 'ranges.json') ) as fh:
+            for rec in json.load( fh ):
+                span = Katana.decode_array( rec['lastAddr'] ) - Katana.decode_array( rec['baseAddr'] )
+                self.define( rec['baseAddr'], span + 1 )
+
+        for name in ('amplifier.json', 'simple_dsp.json', 'color_assign.json'):
+            with open( os.path.join(datadir, name) ) as fh:
+                self._walk( json.load( fh ) )
+
+        with open( os.path.join(datadir, 'complex_dsp.json') ) as fh:
+            parms = json.load( fh )
+        for category, table in parms['baseAddr'].items():
+            for dsp, base in table.items():
+                self._block( base, parms['parameters'][dsp] )
+        self._block( parms['masterKey']['baseAddr'], parms['masterKey'] )
+
+        with open( os.path.join(datadir, 'system.json') ) as fh:
+            for rec in json.load( fh ).values():
+                self.define( rec['addr'], 1 )
+                self.write( rec['addr'], (MemoryImage.default_value( rec ),) )
+
+    def _walk( self, node ):
+        if isinstance( node, dict ):
+            if 'baseAddr' in node and 'length' in node:
+                self._block( node['baseAddr'], node )
+            for child in node.values():
+                self._walk( child )
+
+    def _block( self, base, rec ):
+        self.define( base, rec['length'] )
+        for parm in rec.get( 'parameters', {} ).values():
+            if 'offset' in parm and 'values' in parm:
+                self.write( Katana.effective_addr( base, parm['offset'] ),
+                            (MemoryImage.default_value( parm ),) )
+
+    # Pick a power-on value for a parameter record
+    @staticmethod
+    def default_value( parm ):
+        values = parm.get( 'values', [0] )
+        if parm.get( 'dataType' ) == 'centeredByteRange' and len( values ) > 1:
+            return values[1]
+        return values[0]
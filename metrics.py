@@ -0,0 +1,175 @@
+#!/usr/bin/python3
+#
+# Runtime metrics for the bridge: counters, latency histograms and
+# gauges, kept in this module so any part of the code can record
+# without holding a reference to anything.
+#
+#  - count( name ) bumps a counter (a dict update; cheap enough for
+#    every MIDI message)
+#  - record( name, seconds ) adds a sample to a log-linear ("HDR
+#    style") histogram: exact below 16 usec, then 16 buckets per
+#    power of two, so percentiles are within ~6% at any scale
+#  - gauge( name, fn ) registers a callable read only when a report
+#    is made
+#
+# Updates take no lock.  Under contention an increment can very rarely
+# be lost, which is the price of keeping the hot path free.
+#
+# report() renders everything as text.  The bridge serves it on a Unix
+# socket and writes it to a file on SIGUSR1.
+#
+# Usage: metrics.py [socket]   (prints the running bridge's metrics)
+#
+
+import os
+import sys
+import time
+import socket
+
+# Sub-buckets per power of two
+SUB_BITS = 4
+SUB = 1 << SUB_BITS
+
+PERCENTILES = ( 50, 90, 99, 99.9 )
+
+class Histogram:
+
+    def __init__( self ):
+        # Bucket index -> samples, values in microseconds
+        self.buckets = {}
+        self.count = 0
+        self.total = 0
+        self.min = None
+        self.max = None
+
+    @staticmethod
+    def index( value ):
+        if value < SUB:
+            return value
+        shift = value.bit_length() - SUB_BITS - 1
+        return shift * SUB + (value >> shift)
+
+    # Lowest value that lands in a bucket
+    @staticmethod
+    def lower( index ):
+        if index < 2 * SUB:
+            return index
+        shift = index // SUB - 1
+        return (index - shift * SUB) << shift
+
+    def record( self, seconds ):
+        value = int( seconds * 1000000 )
+        i = Histogram.index( value )
+        self.buckets[i] = self.buckets.get( i, 0 ) + 1
+        self.count += 1
+        self.total += value
+        if self.min == None or value < self.min:
+            self.min = value
+        if self.max == None or value > self.max:
+            self.max = value
+
+    # Value (usec) at or below which 'pct' percent of samples fall,
+    # reported as the top of its bucket
+    def percentile( self, pct ):
+        if self.count == 0:
+            return None
+        wanted = self.count * pct / 100
+        seen = 0
+        for i in sorted( self.buckets ):
+            seen += self.buckets[i]
+            if seen >= wanted:
+                return min( Histogram.lower( i + 1 ) - 1, self.max )
+        return self.max
+
+    def summary( self ):
+        if self.count == 0:
+            return "no samples"
+        parts = [ "n=%d" % self.count, "min=%s" % fmt_usec( self.min ) ]
+        parts += [ "p%g=%s" % (pct, fmt_usec( self.percentile( pct ) )) for pct in PERCENTILES ]
+        parts += [ "max=%s" % fmt_usec( self.max ), "mean=%s" % fmt_usec( self.total // self.count ) ]
+        return " ".join( parts )
+
+def fmt_usec( value ):
+    if value >= 10000:
+        return "%.1fms" % (value / 1000)
+    return "%dus" % value
+
+counters = {}
+histograms = {}
+gauges = {}
+started = time.time()
+
+def count( name, n=1 ):
+    counters[name] = counters.get( name, 0 ) + n
+
+def record( name, seconds ):
+    hist = histograms.get( name )
+    if hist == None:
+        hist = histograms.setdefault( name, Histogram() )
+    hist.record( seconds )
+
+def gauge( name, fn ):
+    gauges[name] = fn
+
+# Resident set size in bytes, from /proc
+def memory_rss():
+    try:
+        with open( '/proc/self/statm' ) as fh:
+            return int( fh.read().split()[1] ) * os.sysconf( 'SC_PAGE_SIZE' )
+    except ( OSError, ValueError ):
+        return None
+
+gauge( 'memory.rss', memory_rss )
+
+def report():
+    lines = [ "uptime %d s" % (time.time() - started) ]
+
+    lines.append( "counters:" )
+    for name in sorted( counters ):
+        lines.append( "  %-28s %d" % (name, counters[name]) )
+
+    lines.append( "gauges:" )
+    for name in sorted( gauges ):
+        try:
+            value = gauges[name]()
+        except Exception as e:
+            value = "error: %s" % e
+        lines.append( "  %-28s %s" % (name, value) )
+
+    lines.append( "latency:" )
+    for name in sorted( histograms ):
+        lines.append( "  %-28s %s" % (name, histograms[name].summary()) )
+
+    return "\n".join( lines ) + "\n"
+
+def dump( filename ):
+    tmpfile = filename + ".tmp"
+    with open( tmpfile, 'w' ) as fh:
+        fh.write( report() )
+    os.replace( tmpfile, filename )
+
+# Serve report() to anyone who connects to a Unix socket at 'path'
+async def serve( path ):
+    import asyncio
+
+    async def client( reader, writer ):
+        writer.write( report().encode() )
+        await writer.drain()
+        writer.close()
+
+    if os.path.exists( path ):
+        os.unlink( path )
+    return await asyncio.start_unix_server( client, path=path )
+
+
+if __name__ == '__main__':
+    from startup import RUNDIR
+    path = sys.argv[1] if len( sys.argv ) > 1 else RUNDIR + "metrics.sock"
+
+    with socket.socket( socket.AF_UNIX, socket.SOCK_STREAM ) as sock:
+        sock.connect( path )
+        while True:
+            data = sock.recv( 4096 )
+            if not data:
+                break
+            sys.stdout.write( data.decode() )
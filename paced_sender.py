@@ -0,0 +1,130 @@
+# Paced output to the amp.  Every outgoing message goes through a
+# bounded queue to a single sender thread, which spaces messages out
+# according to a byte budget (bytes per second) and a minimum gap
+# between frames.  The amp's USB MIDI input silently drops data when
+# it overruns, so large transmits are held to what it reliably accepts;
+# callers block when the queue is full.
+#
+# With no budget and no gap (the default) messages go out as fast as
+# the port takes them, in order.
+#
+# notify() queues a callback that runs on the sender thread once
+# everything queued before it has gone out.
+#
+# adjust() moves the budget up or down by the result of a read-back
+# check (see katana_convert), so the rate can be calibrated against
+# what the amp actually stored.
+
+import time
+import queue
+import threading
+from collections import deque
+
+import metrics
+import traffic_log
+
+class PacedSender:
+
+    # Budget limits used by adjust(), bytes per second
+    MIN_RATE = 1000
+    MAX_RATE = 100000
+
+    def __init__( self, port, rate=None, gap=0.0, depth=64 ):
+        self.port = port
+        self.rate = rate
+        self.gap = gap
+        self.queue = queue.Queue( maxsize=depth )
+        self.next_time = 0
+
+        # Counters
+        self.frames = 0
+        self.bytes = 0
+
+        # (time, size) of recent sends, for throughput()
+        self.recent = deque( maxlen=256 )
+
+        self.thread = threading.Thread( target=self._run, daemon=True )
+        self.thread.start()
+
+    # Queue a message.  Blocks while the queue is full.
+    def send( self, msg ):
+        self.queue.put( msg )
+
+    # Call fn() from the sender thread once everything queued so far
+    # has been sent
+    def notify( self, fn ):
+        self.queue.put( fn )
+
+    def _run( self ):
+        while True:
+            msg = self.queue.get()
+            if msg is None:
+                self.queue.task_done()
+                return
+            if callable( msg ):
+                msg()
+                self.queue.task_done()
+                continue
+
+            now = time.monotonic()
+            if now < self.next_time:
+                time.sleep( self.next_time - now )
+
+            self.port.send( msg )
+            traffic_log.record( traffic_log.OUT, traffic_log.AMP, msg )
+
+            size = len( msg )
+            now = time.monotonic()
+            spacing = self.gap
+            if self.rate != None:
+                spacing = max( spacing, size / self.rate )
+            self.next_time = now + spacing
+
+            self.frames += 1
+            self.bytes += size
+            metrics.count( 'amp_out.' + msg.type )
+            metrics.count( 'amp_out.bytes', size )
+            self.recent.append( (now, size) )
+            self.queue.task_done()
+
+    # Block until everything queued so far has been sent
+    def wait_idle( self ):
+        self.queue.join()
+
+    # Messages waiting to be sent
+    def depth( self ):
+        return self.queue.qsize()
+
+    # Achieved bytes per second over the last 'window' seconds
+    def throughput( self, window=1.0 ):
+        cutoff = time.monotonic() - window
+        return sum( size for when, size in list( self.recent ) if when >= cutoff ) / window
+
+    # Rate over the most recent sends, ignoring idle time before them
+    def burst_rate( self ):
+        recent = list( self.recent )
+        if len( recent ) < 2 or recent[-1][0] == recent[0][0]:
+            return None
+        return sum( size for when, size in recent[1:] ) / (recent[-1][0] - recent[0][0])
+
+    # Feed back the result of a read-back check: raise the budget by a
+    # quarter after a clean transfer, halve it after a lossy one.  An
+    # unlimited sender starts from the rate it last achieved.
+    def adjust( self, ok ):
+        rate = self.rate
+        if rate == None:
+            if ok:
+                return None
+            rate = min( max( self.burst_rate() or self.MAX_RATE, self.MIN_RATE ), self.MAX_RATE )
+
+        if ok:
+            rate = min( rate * 1.25, self.MAX_RATE )
+        else:
+            rate = max( rate / 2, self.MIN_RATE )
+        self.rate = rate
+        return rate
+
+    # Send what is queued, then stop the thread
+    def close( self ):
+        self.queue.put( None )
+        self.thread.join()
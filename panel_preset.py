@@ -5,11 +5,14 @@
 #
 
 import sys
-import re
+import hashlib
 from time import sleep
 from globals import *
 from pprint import pprint
 
+from katana import Katana
+from write_planner import WritePlanner
+
 class ParmRec:
     def __init__( self, addr=None, data=None, memo="" ):
         self.addr = addr
@@ -27,45 +30,17 @@ class PanelPreset:
     Start, SawId, SawAddr, SawData, Done = range( 5 )
 
     # Static generator to create multiple PanelPreset objects by parsing a
-    # text file input stream
+    # text file input stream.  Bad stanzas are skipped and reported once
+    # the stream is exhausted (see PresetParser).
     #
     @staticmethod
     def get_from_file( infh ):
-        rx = re.compile( '#\s*' )
+        from preset_parser import PresetParser
 
-        lineNum = 0
-        obj = PanelPreset()
-        for line in infh:
-            lineNum += 1
-            line = line.strip()
-            if len( line ) == 0: continue
-            if re.match( r'^#', line ):
-                # If we're in a preset stanza gather comments, removing any
-                # '#' char prefix.
-                if obj.curr_rec != None:
-                    obj.curr_rec.memo += rx.sub( '', line )
-                continue
-
-            try:
-                type, value = line.split( ' ', 1 )
-            except ValueError:
-                print( "Parse error at line %d. Expected more than one token." % lineNum )
-                sys.exit( 1 )
-
-            # First token in input line names the handler.  
-            handler = getattr( obj, type, None )
-            if handler == None:
-                print( "Parse error at line %d. Line type %s unknown" % (lineNum, type) )
-                sys.exit( 1 )
-            else:
-                handler( value, lineNum )
-
-            if obj.state == obj.Done:
-                yield obj
-                obj = PanelPreset()
-                
-        if obj.state != obj.Start:
-            print( "Parse error at line %d." % lineNum )
+        parser = PresetParser()
+        yield from parser.parse( infh )
+        for lineNum, text in parser.errors:
+            print( "Parse error at line %d. %s." % (lineNum, text) )
 
     # Static factory method to create a single PanelPreset object by reading
     # current amplifier state
@@ -76,15 +51,20 @@ class PanelPreset:
         obj.state = obj.Done
         obj.id = preset_id
 
-        for rec in rangeObj.get_coords():
-            first = rec['baseAddr']
-            last = rec['lastAddr']
+        # All ranges are requested up front and read back as the
+        # replies arrive, rather than one round trip at a time.  A
+        # capture must reflect the amp, so the read cache is bypassed.
+        coords = rangeObj.get_coords()
+        ranges = [ (rec['baseAddr'], rec['lastAddr'], rec.get( 'chunks' )) for rec in coords ]
+        results = katana.query_sysex_ranges( ranges, bypass=True )
+
+        for rec, (addr, data) in zip( coords, results ):
             name = rec['name']
-            addr, data = katana.query_sysex_range( first, last )
             for a, d in zip( addr, data ):
                 parm = ParmRec( a, d, name )
                 obj.parms.append( parm )
-        
+
+        obj.compile( katana.planner )
         return obj
 
     def __init__( self ):
@@ -94,75 +74,112 @@ class PanelPreset:
         self.by_addr = {}
         self.curr_rec = None
         self.parms = []
-        
-    # State machine handlers for parsing data file:
-        
-    def _preset( self, value, lineNum ):
-        if self.state != self.Start:
-            print( "Phase error at line %d. Expected Start, but was %d." % (lineNum, self.state) )
-            sys.exit( 1 )
-
-        try:
-            self.id = int( value )
-            self.curr_rec = ParmRec()
-            self.state = self.SawId
-
-        except ValueError:
-            print( "Parse error at line %d. Expecting single integer." )
-            sys.exit( 1 )
-
-    def _addr( self, value, lineNum ):
-        if self.state != self.SawId and self.state != self.SawData:
-            print( "Phase error at line %d. Expected SawId or SawData, but was %d." % (lineNum, self.state) )
-            sys.exit( 1 )
-
-        address_bytes = []
-        for hex in value.split():
-            address_bytes.append( int(hex,16) )
-
-        self.curr_rec.addr = tuple( address_bytes )
-        self.state = self.SawAddr
-
-    def _data( self, value, lineNum ):
-        if self.state != self.SawAddr: 
-            print( "Phase error at line %d. Expected SawAddr, but was %d." % (lineNum, self.state) )
-            sys.exit( 1 )
-
-        data = []
-        for hex in value.split():
-            data.append( int(hex,16) )
-
-        self.curr_rec.data = tuple( data )
-        self.parms.append( self.curr_rec )
-        self.by_addr[ self.curr_rec.addr ] = self.curr_rec
-        self.curr_rec = ParmRec()
-        self.state = self.SawData
-
-    def _endPreset( self, value, lineNum ):
-        if self.state != self.SawData:
-            print( "Phase error at line %d. Expected SawData, but was %d." % (lineNum, self.state) )
-            sys.exit( 1 )
-
-        try:
-            endId = int( value )
-        except ValueError:
-            print( "Parse error at line %d. Expecting single integer." % lineNum )
-            sys.exit( 1 )
-
-        if endId != self.id:
-            print( "Parse error at line %d. Preset number mismatch. Expected %d, but saw %d." % (lineNum, self.id, endId) )
-            sys.exit( 1 )
-            
-        self.state = self.Done
 
-    # Send current data set to amplifier
-    def transmit( self, katanaObj ):
+        # Ready-to-send frames, built by compile()
+        self.frames = None
+
+        # Content digest, see digest()
+        self._digest = None
+        
+    # Merge parameter records into the fewest writes and build a
+    # checksummed frame for each, so a recall only has to push cached
+    # messages.  Each entry is (start, data, frame), or (None, msec,
+    # None) for a delay. Call again if parms are changed.  Pass the
+    # amp's planner (Katana.planner) so its saved message/byte counters
+    # include this preset.
+    def compile( self, planner=None ):
+        if planner == None:
+            planner = WritePlanner()
+        items = []
         for parm in self.parms:
             if parm.addr[0] == 0xff:
-                sleep( parm.data[0]/1000 )
+                items.append( (None, parm.data[0]) )
+            else:
+                items.append( (Katana.decode_array( parm.addr ), parm.data) )
+
+        self._digest = None
+        self.frames = []
+        for start, data in planner.plan( items ):
+            if start == None:
+                self.frames.append( (None, data, None) )
+            else:
+                frame = Katana.make_frame( Katana.encode_scalar( start ), data )
+                self.frames.append( (start, data, frame) )
+        return self.frames
+
+    # Digest of a list of parameter records.  Contiguous records are
+    # hashed as one span, so the result depends only on the addresses
+    # and data, not on how they were split into records (or on memos).
+    @staticmethod
+    def span_digest( parms ):
+        h = hashlib.blake2b( digest_size=16 )
+        end = None
+        for parm in parms:
+            if parm.addr[0] == 0xff:
+                h.update( b'd' + bytes( parm.data ) )
+                end = None
+                continue
+
+            start = Katana.decode_array( parm.addr )
+            if start != end:
+                h.update( b'a' + start.to_bytes( 4, 'little' ) )
+            h.update( bytes( parm.data ) )
+            end = start + len( parm.data )
+        return h.digest()
+
+    # Stable content digest of the whole preset.  Cached; compile()
+    # resets it, so call that after changing parms.
+    def digest( self ):
+        if self._digest == None:
+            self._digest = PanelPreset.span_digest( self.parms )
+        return self._digest
+
+    # Digest of each record (one reply chunk of a capture), keyed by
+    # "<range name> @ <address>"
+    def span_digests( self ):
+        return { "%s @ %s" % (parm.memo, ' '.join( "%02x" % b for b in parm.addr )):
+                 PanelPreset.span_digest( [ parm ] ) for parm in self.parms }
+
+    # Read the ranges this preset was captured from again and compare
+    # them span by span.  Returns the spans that differ.
+    def verify_with_amp( self, katana, rangeObj ):
+        check = PanelPreset.read_from_amp( katana, self.id, rangeObj )
+        mine = self.span_digests()
+        theirs = check.span_digests()
+        names = list( mine ) + [ name for name in theirs if name not in mine ]
+        return [ name for name in names if mine.get( name ) != theirs.get( name ) ]
+
+    # Send current data set to amplifier.  By default only bytes that
+    # differ from the amp's shadow image are sent; 'force' sends
+    # everything (use to resync after the amp was changed behind our
+    # back).  Whole blocks go out as cached frames. Partial changes
+    # are sent as smaller messages built on the fly.
+    def transmit( self, katanaObj, force=False ):
+        for delay in self.transmit_steps( katanaObj, force ):
+            sleep( delay )
+
+    # Generator form of transmit().  Sends everything up to the next
+    # delay record, then yields the delay in seconds so the caller can
+    # wait without blocking (e.g. asyncio.sleep).
+    def transmit_steps( self, katanaObj, force=False ):
+        if self.frames == None:
+            self.compile( katanaObj.planner )
+
+        for start, data, frame in self.frames:
+            if start == None:
+                yield data/1000
                 continue
 
-            katanaObj.send_sysex_data( parm.addr, parm.data )
+            if force:
+                katanaObj.send_frame( frame, start, data )
+                continue
+
+            spans = katanaObj.shadow.diff( start, data )
+            if len( spans ) == 1 and len( spans[0][1] ) == len( data ):
+                katanaObj.send_frame( frame, start, data )
+            else:
+                for span_start, span in spans:
+                    katanaObj.send_sysex_data( Katana.encode_scalar( span_start ), span )
 
     # Print current data set to passed filehandle.
     def serialize( self, outfh ):
@@ -6,7 +6,6 @@
 
 import sys
 import re
-from time import sleep
 from globals import *
 from pprint import pprint
 
@@ -213,12 +212,8 @@ class PanelPresetOld:
 
     # Send current data set to amplifier
     def transmit( self, katanaObj ):
-        for parm in self.parms:
-            if parm.addr[0] == 0xff:
-                sleep( parm.data[0]/1000 )
-                continue
-
-            katanaObj.send_sysex_data( parm.addr, parm.data )
+        writes = [ (parm.addr, parm.data) for parm in self.parms ]
+        katanaObj.send_writes( writes )
 
     # Print current data set to passed filehandle.
     def serialize( self, outfh ):
@@ -0,0 +1,236 @@
+#!/usr/bin/python3
+#
+# Single compiled view of everything in parameters/*.json (plus the
+# fixed addresses in globals.py):
+#
+#  - every parameter by dotted name, e.g. 'amplifier.frontPanel.gain'
+#    or 'complex_dsp.mod.T-Wah.peak'
+#  - an interval index answering "which parameter owns this address?"
+#  - value <--> display tables for byteRange, centeredByteRange, enum
+#    and boolean parameters
+#
+# Compiling means parsing all the JSON, so the result is cached (see
+# compile_cache.py) keyed by the source files' mtimes and sizes; later
+# starts load the cache instead.  Lookups by name are a dict access and
+# lookups by address a binary search.
+#
+# Usage: parameter_registry.py <name | xx xx xx xx> ...
+#
+
+import os
+import sys
+import json
+from bisect import bisect_left, bisect_right
+
+import globals
+import compile_cache
+from katana import Katana
+
+# Bump when the compiled layout changes
+CACHE_VERSION = 1
+
+# Width in bytes of each data type on the wire
+SIZES = { 'wordRange': 2 }
+
+class Parameter:
+
+    def __init__( self, name, addr, size, rec, table=None ):
+        self.name = name
+        self.addr = addr
+        self.size = size
+        self.dataType = rec.get( 'dataType', 'enum' if table != None else None )
+        self.values = rec.get( 'values' )
+        self.display = rec.get( 'display', rec.get( 'displayValues', rec.get( 'displayRange' ) ) )
+
+        # Raw value -> display value, and back
+        self.to_display = None
+        self.from_display = None
+        if table != None:
+            self.values, self.display = table
+        self._build_tables()
+
+    def _build_tables( self ):
+        kind = self.dataType
+        if kind in ('enum', 'boolean') and self.values != None and self.display != None:
+            pairs = list( zip( self.values, self.display ) )
+        elif kind == 'byteRange' and self.values != None:
+            lo, hi = self.values
+            dlo, dhi = self.display if self.display != None else (lo, hi)
+            pairs = [ (v, Parameter._scale( v, lo, hi, dlo, dhi )) for v in range( lo, hi + 1 ) ]
+        elif kind == 'centeredByteRange' and self.values != None:
+            lo, mid, hi = self.values
+            dlo, dmid, dhi = self.display if self.display != None else (lo - mid, 0, hi - mid)
+            pairs = [ (v, Parameter._scale( v, lo, mid, dlo, dmid )) for v in range( lo, mid ) ]
+            pairs += [ (v, Parameter._scale( v, mid, hi, dmid, dhi )) for v in range( mid, hi + 1 ) ]
+        else:
+            return
+
+        self.to_display = dict( pairs )
+        self.from_display = { d: v for v, d in pairs }
+
+    # Linear map of v from [lo, hi] onto [dlo, dhi], rounded
+    @staticmethod
+    def _scale( v, lo, hi, dlo, dhi ):
+        if hi == lo:
+            return dlo
+        return int( round( dlo + (v - lo) * (dhi - dlo) / (hi - lo) ) )
+
+    def __repr__( self ):
+        return "<%s %s+%d %s>" % (self.name, Katana.encode_scalar( self.addr ), self.size, self.dataType)
+
+
+class ParameterRegistry:
+
+    SOURCES = ( 'amplifier.json', 'simple_dsp.json', 'complex_dsp.json',
+                'color_assign.json', 'system.json' )
+
+    # Pass cache=False to always compile from the JSON
+    def __init__( self, datadir, cache=True ):
+        self.datadir = datadir
+
+        if cache:
+            sources = [ os.path.join( datadir, name ) for name in self.SOURCES ]
+            sources.append( globals.__file__ )
+            compiled = compile_cache.cached( 'parameters.cache', sources, self._compile, CACHE_VERSION )
+        else:
+            compiled = self._compile()
+
+        ( self.params, self.starts, self.owners ) = compiled
+
+    # Lookups
+
+    def get( self, name ):
+        return self.params.get( name )
+
+    def names( self ):
+        return sorted( self.params.keys() )
+
+    # 4-byte address of a parameter
+    def address( self, name ):
+        return Katana.encode_scalar( self.params[name].addr )
+
+    # All parameters covering an address (4-byte list or scalar).  More
+    # than one when the metadata overlaps, e.g. front-panel knobs that
+    # share a byte.
+    def at( self, addr ):
+        if not isinstance( addr, int ):
+            addr = Katana.decode_array( addr )
+        i = bisect_right( self.starts, addr ) - 1
+        if i < 0:
+            return []
+        return [ self.params[name] for name in self.owners[i] ]
+
+    # First parameter covering an address, or None
+    def owner( self, addr ):
+        found = self.at( addr )
+        return found[0] if found else None
+
+    def to_display( self, name, value ):
+        return self.params[name].to_display[value]
+
+    def from_display( self, name, display ):
+        return self.params[name].from_display[display]
+
+    # Compilation
+
+    def _compile( self ):
+        params = {}
+        def add( name, addr, size, rec, table=None ):
+            params[name] = Parameter( name, Katana.decode_array( addr ), size, rec, table )
+
+        def load( name ):
+            with open( os.path.join( self.datadir, name ) ) as fh:
+                return json.load( fh )
+
+        # Blocks whose parameters are described by offset
+        def block( prefix, base, rec, tables={} ):
+            parms = rec.get( 'parameters' )
+            if not parms:
+                add( prefix, base, rec['length'], rec )
+                return
+            for pname, prec in parms.items():
+                addr = Katana.effective_addr( base, prec['offset'] )
+                ref = prec.get( 'tableRef' )
+                add( prefix + '.' + pname, addr, SIZES.get( prec.get( 'dataType' ), 1 ), prec, tables.get( ref ) )
+
+        for bname, rec in load( 'amplifier.json' ).items():
+            block( 'amplifier.' + bname, rec['baseAddr'], rec )
+
+        simple = load( 'simple_dsp.json' )
+        tables = {}
+        for key, rec in simple['models'].items():
+            tables['modelSubtypes:' + key] = ( rec['values'], rec['display'] )
+        for bname, rec in simple['parameters'].items():
+            block( 'simple_dsp.' + bname, rec['baseAddr'], rec, tables )
+
+        complex = load( 'complex_dsp.json' )
+        tables = { 'class': ( complex['class']['values'], complex['class']['display'] ) }
+        for category, table in complex['baseAddr'].items():
+            for dsp, base in table.items():
+                block( 'complex_dsp.%s.%s' % (category, dsp), base, complex['parameters'][dsp], tables )
+        block( 'complex_dsp.masterKey', complex['masterKey']['baseAddr'], complex['masterKey'] )
+
+        color = load( 'color_assign.json' )
+        tables = { 'colorEnum': ( color['colorEnum']['values'], color['colorEnum']['display'] ) }
+        for bname, rec in color.items():
+            if isinstance( rec, dict ) and 'baseAddr' in rec:
+                offsets = rec.get( 'categoryOffset', rec.get( 'knobOffset' ) )
+                if offsets == None:
+                    add( 'color_assign.' + bname, rec['baseAddr'], rec['length'], rec )
+                    continue
+                for pname, offset in offsets.items():
+                    add( 'color_assign.%s.%s' % (bname, pname),
+                         Katana.effective_addr( rec['baseAddr'], offset ), 1, rec,
+                         tables.get( rec.get( 'tableRef' ) ) )
+
+        for pname, rec in load( 'system.json' ).items():
+            add( 'system.' + pname, rec['addr'], 1, rec )
+
+        # Fixed addresses from globals.py, e.g. globals.VOLUME_PEDAL
+        for gname in dir( globals ):
+            if gname.endswith( '_ADDR' ):
+                short = gname[:-len( '_ADDR' )]
+                size = getattr( globals, short + '_LEN', 1 )
+                add( 'globals.' + short, getattr( globals, gname ), size, {} )
+
+        # Interval index: cut the address space at every parameter
+        # boundary and record which parameters cover each segment.
+        bounds = set()
+        for parm in params.values():
+            bounds.add( parm.addr )
+            bounds.add( parm.addr + parm.size )
+        bounds = sorted( bounds )
+
+        covering = { b: [] for b in bounds }
+        for parm in params.values():
+            i = bisect_left( bounds, parm.addr )
+            while bounds[i] < parm.addr + parm.size:
+                covering[ bounds[i] ].append( parm.name )
+                i += 1
+
+        starts = []
+        owners = []
+        for b in bounds:
+            starts.append( b )
+            owners.append( sorted( covering[b] ) )
+
+        return ( params, starts, owners )
+
+
+if __name__ == '__main__':
+    scriptdir = os.path.dirname( os.path.abspath(__file__) )
+    registry = ParameterRegistry( scriptdir + '/parameters/' )
+
+    args = sys.argv[1:]
+    if not args:
+        print( "%d parameters" % len( registry.params ) )
+    elif len( args ) == 4 and all( len( a ) == 2 for a in args ):
+        addr = [ int( a, 16 ) for a in args ]
+        for parm in registry.at( addr ):
+            print( parm )
+    else:
+        for name in args:
+            parm = registry.get( name )
+            print( parm if parm != None else "%s: unknown" % name )
+            if parm != None and parm.to_display != None:
+                print( "  ", parm.to_display )
@@ -0,0 +1,105 @@
+#!/usr/bin/python3
+#
+# Append-only journal of captured presets.  Each capture appends one
+# framed, checksummed record and fsyncs, so the cost of persisting a
+# capture does not depend on the size of the library.  At startup the
+# journal is replayed over the last snapshot (the preset file), and a
+# torn record left by a power cut is truncated away.  Once the journal
+# grows past a threshold the owner writes a fresh snapshot and resets
+# the journal.
+#
+# Frame (little-endian):
+#
+#   magic:u32  length:u32  crc32:u32  payload[length]
+#
+# Payload is the preset id (u32) followed by the PresetStore encoding
+# of the preset.
+#
+
+import os
+import sys
+import struct
+import syslog
+import zlib
+
+from preset_store import PresetStore
+
+FRAME = struct.Struct( '<III' )
+FRAME_MAGIC = 0x4b4a524e
+PROGRAM = struct.Struct( '<I' )
+
+class PresetJournal:
+
+    def __init__( self, filename, threshold=256 * 1024 ):
+        self.filename = filename
+        self.threshold = threshold
+
+    def size( self ):
+        try:
+            return os.path.getsize( self.filename )
+        except OSError:
+            return 0
+
+    def needs_compaction( self ):
+        return self.size() > self.threshold
+
+    # Apply every intact record to 'presets' (a dict or PresetStore),
+    # in order.  Anything after the first bad frame is discarded.
+    # Returns the number of records applied.
+    def replay( self, presets ):
+        if not os.path.isfile( self.filename ):
+            return 0
+
+        with open( self.filename, 'rb' ) as fh:
+            buf = fh.read()
+
+        count = 0
+        pos = 0
+        while pos + FRAME.size <= len( buf ):
+            magic, length, crc = FRAME.unpack_from( buf, pos )
+            payload = buf[pos + FRAME.size:pos + FRAME.size + length]
+            if magic != FRAME_MAGIC or len( payload ) != length or zlib.crc32( payload ) != crc:
+                break
+
+            program, = PROGRAM.unpack_from( payload, 0 )
+            presets[program] = PresetStore.decode( program, payload[PROGRAM.size:] )
+            count += 1
+            pos += FRAME.size + length
+
+        if pos != len( buf ):
+            syslog.syslog( "Truncating %d bytes of torn journal %s" % (len( buf ) - pos, self.filename) )
+            with open( self.filename, 'r+b' ) as fh:
+                fh.truncate( pos )
+                fh.flush()
+                os.fsync( fh.fileno() )
+
+        return count
+
+    # Payload for a preset.  Cheap enough to build on the caller's
+    # thread, so append() can run elsewhere without touching 'rec'.
+    @staticmethod
+    def encode( rec ):
+        return PROGRAM.pack( rec.id ) + PresetStore.encode( rec )
+
+    # Durably append one encoded preset
+    def append( self, payload ):
+        frame = FRAME.pack( FRAME_MAGIC, len( payload ), zlib.crc32( payload ) ) + payload
+        with open( self.filename, 'ab' ) as fh:
+            fh.write( frame )
+            fh.flush()
+            os.fsync( fh.fileno() )
+
+    # Empty the journal.  Only call once a snapshot containing all of
+    # its records is safely on disk.
+    def reset( self ):
+        with open( self.filename, 'wb' ) as fh:
+            fh.flush()
+            os.fsync( fh.fileno() )
+
+
+if __name__ == '__main__':
+    # Show what a journal holds
+    presets = {}
+    journal = PresetJournal( sys.argv[1] )
+    count = journal.replay( presets )
+    print( "%d records, presets: %s" % (count, sorted( presets.keys() )) )
@@ -0,0 +1,169 @@
+#!/usr/bin/python3
+#
+# Streaming parser for the text preset format written by
+# PanelPreset.serialize():
+#
+#   _preset 12
+#   # memo
+#   _addr 60 00 00 30
+#   _data 00 01 02 ..
+#   _endPreset 12
+#
+# Presets are yielded as they complete.  Hex is decoded a whole line
+# at a time, and frames are left to be compiled on first recall.  A bad
+# line does not stop the parse: the error is recorded with its line
+# number, the preset it belongs to is dropped and parsing resumes at
+# the next '_preset'.
+#
+# Usage: preset_parser.py <preset_file>   (reports presets and errors)
+#
+
+import re
+import sys
+
+from panel_preset import PanelPreset, ParmRec
+
+# Same comment stripping as the original parser, so memos round-trip
+COMMENT = re.compile( r'#\s*' )
+
+class PresetParser:
+
+    # Parser state
+    Start, SawId, SawAddr, SawData, Skip = range( 5 )
+
+    def __init__( self ):
+        # (line number, message) for every problem found
+        self.errors = []
+
+    def _error( self, lineNum, text ):
+        self.errors.append( (lineNum, text) )
+
+    # Decode a line of space separated hex bytes, or None if malformed
+    @staticmethod
+    def hex_bytes( value ):
+        try:
+            return tuple( bytes.fromhex( value ) )
+        except ValueError:
+            pass
+
+        # Slow path for single-digit tokens
+        try:
+            return tuple( int( token, 16 ) for token in value.split() )
+        except ValueError:
+            return None
+
+    # Generator yielding a PanelPreset for every complete, well-formed
+    # preset in 'infh'.
+    def parse( self, infh ):
+        state = self.Start
+        obj = None
+        addr = None
+        memo = None
+
+        lineNum = 0
+        for line in infh:
+            lineNum += 1
+            line = line.strip()
+            if not line:
+                continue
+
+            if line[0] == '#':
+                # Inside a preset stanza, gather comments as the memo
+                # of the next record.
+                if memo != None:
+                    memo += COMMENT.sub( '', line )
+                continue
+
+            kind, _, value = line.partition( ' ' )
+            if not value:
+                self._error( lineNum, "Expected more than one token" )
+                if state != self.Start:
+                    state = self.Skip
+                continue
+
+            if kind == '_data':
+                if state != self.SawAddr:
+                    if state != self.Skip:
+                        self._error( lineNum, "Unexpected _data" )
+                        state = self.Skip
+                    continue
+
+                data = PresetParser.hex_bytes( value )
+                if data == None:
+                    self._error( lineNum, "Bad hex in _data" )
+                    state = self.Skip
+                    continue
+
+                parm = ParmRec( addr, data, memo )
+                obj.parms.append( parm )
+                obj.by_addr[addr] = parm
+                memo = ""
+                state = self.SawData
+
+            elif kind == '_addr':
+                if state != self.SawId and state != self.SawData:
+                    if state != self.Skip:
+                        self._error( lineNum, "Unexpected _addr" )
+                        state = self.Skip
+                    continue
+
+                addr = PresetParser.hex_bytes( value )
+                if addr == None:
+                    self._error( lineNum, "Bad hex in _addr" )
+                    state = self.Skip
+                    continue
+                state = self.SawAddr
+
+            elif kind == '_preset':
+                if state != self.Start and state != self.Skip:
+                    self._error( lineNum, "Preset %d not terminated" % obj.id )
+
+                obj = PanelPreset()
+                memo = ""
+                try:
+                    obj.id = int( value )
+                    state = self.SawId
+                except ValueError:
+                    self._error( lineNum, "Expecting single integer" )
+                    state = self.Skip
+
+            elif kind == '_endPreset':
+                if state != self.SawData:
+                    if state != self.Skip:
+                        self._error( lineNum, "Unexpected _endPreset" )
+                    state = self.Start
+                    memo = None
+                    continue
+
+                state = self.Start
+                memo = None
+                try:
+                    endId = int( value )
+                except ValueError:
+                    self._error( lineNum, "Expecting single integer" )
+                    continue
+
+                if endId != obj.id:
+                    self._error( lineNum, "Preset number mismatch. Expected %d, but saw %d" % (obj.id, endId) )
+                    continue
+
+                obj.state = obj.Done
+                yield obj
+
+            else:
+                self._error( lineNum, "Line type %s unknown" % kind )
+                if state != self.Start:
+                    state = self.Skip
+
+        if state != self.Start:
+            self._error( lineNum, "Unterminated preset at end of file" )
+
+
+if __name__ == '__main__':
+    parser = PresetParser()
+    with open( sys.argv[1] ) as infh:
+        count = sum( 1 for obj in parser.parse( infh ) )
+
+    print( "%d presets" % count )
+    for lineNum, text in parser.errors:
+        print( "Line %d: %s" % (lineNum, text) )
@@ -0,0 +1,272 @@
+#!/usr/bin/python3
+#
+# Indexed binary preset library.  The file is memory-mapped and its
+# index, sorted by id, is binary-searched in place; a preset is decoded
+# when it is asked for and kept in a bounded LRU.  Startup time and
+# memory therefore stay (nearly) constant no matter how large the
+# library is.
+#
+# Layout (little-endian):
+#
+#   header:  magic[8]  count:u32
+#   index:   count x ( id:u32  offset:u32  length:u32  crc32:u32 )
+#   bodies:  per preset
+#              nparms:u16
+#              nparms x ( alen:u8 addr[alen]  mlen:u16 memo[mlen]
+#                         dlen:u16 data[dlen] )
+#
+# Convert to and from the text format with:
+#
+#   preset_store.py to-binary preset.data preset.bin
+#   preset_store.py to-text preset.bin preset.data
+#
+
+import os
+import sys
+import mmap
+import struct
+import syslog
+import zlib
+from collections import OrderedDict
+
+from panel_preset import PanelPreset, ParmRec
+
+MAGIC = b'KTNPRST1'
+HEADER = struct.Struct( '<8sI' )
+ENTRY = struct.Struct( '<IIII' )
+U8 = struct.Struct( '<B' )
+U16 = struct.Struct( '<H' )
+
+class PresetStore:
+
+    # True if filename holds a binary library (as opposed to text)
+    @staticmethod
+    def is_store( filename ):
+        try:
+            with open( filename, 'rb' ) as fh:
+                return fh.read( len( MAGIC ) ) == MAGIC
+        except OSError:
+            return False
+
+    def __init__( self, filename=None, cache_size=256 ):
+        self.filename = filename
+        self.map = None
+        self.count = 0
+
+        # Most recently used presets decoded from the map
+        self.cache = OrderedDict()
+        self.cache_size = cache_size
+
+        # Presets added since the file was written.  These exist only
+        # in memory (and the journal), so they are never evicted.
+        self.added = {}
+
+        if filename != None and os.path.isfile( filename ):
+            self._open()
+
+    def _open( self ):
+        with open( self.filename, 'rb' ) as fh:
+            self.map = mmap.mmap( fh.fileno(), 0, access=mmap.ACCESS_READ )
+
+        magic, self.count = HEADER.unpack_from( self.map, 0 )
+        if magic != MAGIC:
+            raise ValueError( "%s is not a preset store" % self.filename )
+
+    # Binary search of the on-disk index. Returns (offset, length, crc)
+    # or None.
+    def _find( self, program ):
+        lo = 0
+        hi = self.count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            entry = ENTRY.unpack_from( self.map, HEADER.size + mid * ENTRY.size )
+            if entry[0] == program:
+                return entry[1:]
+            if entry[0] < program:
+                lo = mid + 1
+            else:
+                hi = mid
+        return None
+
+    # Ids in the file, in order
+    def _ids( self ):
+        for i in range( self.count ):
+            yield ENTRY.unpack_from( self.map, HEADER.size + i * ENTRY.size )[0]
+
+    def close( self ):
+        if self.map != None:
+            self.map.close()
+            self.map = None
+            self.count = 0
+
+    # Drop decoded presets and re-read the index, e.g. after the file
+    # was rewritten, optionally from a new file.  'saved' is the copy of
+    # 'added' the new file was written from: those presets are now on
+    # disk and are let go, while anything added since is kept.
+    def reload( self, filename=None, saved=None ):
+        self.close()
+        if filename != None:
+            self.filename = filename
+        self.cache = OrderedDict()
+        if saved == None:
+            self.added = {}
+        else:
+            self.added = { program: rec for program, rec in self.added.items()
+                           if saved.get( program ) is not rec }
+        self._open()
+
+    # Mapping interface, so the bridge can use a store in place of a
+    # dict of presets.
+
+    def __contains__( self, program ):
+        return program in self.added or program in self.cache or self._find( program ) != None
+
+    def __getitem__( self, program ):
+        rec = self.get( program )
+        if rec == None:
+            raise KeyError( program )
+        return rec
+
+    def __setitem__( self, program, rec ):
+        self.cache.pop( program, None )
+        self.added[program] = rec
+
+    def __len__( self ):
+        return len( self.keys() )
+
+    def keys( self ):
+        return sorted( set( self._ids() ) | set( self.added ) )
+
+    def values( self ):
+        return [ self[program] for program in self.keys() ]
+
+    def items( self ):
+        return [ (program, self[program]) for program in self.keys() ]
+
+    def get( self, program, default=None ):
+        if program in self.added:
+            return self.added[program]
+        if program in self.cache:
+            self.cache.move_to_end( program )
+            return self.cache[program]
+
+        entry = self._find( program )
+        if entry == None:
+            return default
+
+        offset, length, crc = entry
+        body = self.map[offset:offset + length]
+        if zlib.crc32( body ) != crc:
+            syslog.syslog( "Preset %d in %s fails checksum" % (program, self.filename) )
+            return default
+
+        rec = PresetStore.decode( program, body )
+        self.cache[program] = rec
+        if len( self.cache ) > self.cache_size:
+            self.cache.popitem( last=False )
+        return rec
+
+    @staticmethod
+    def encode( rec ):
+        out = bytearray( U16.pack( len( rec.parms ) ) )
+        for parm in rec.parms:
+            memo = parm.memo.encode( 'utf-8' )
+            out += U8.pack( len( parm.addr ) ) + bytes( parm.addr )
+            out += U16.pack( len( memo ) ) + memo
+            out += U16.pack( len( parm.data ) ) + bytes( parm.data )
+        return bytes( out )
+
+    @staticmethod
+    def decode( program, body ):
+        obj = PanelPreset()
+        obj.id = program
+        obj.state = obj.Done
+
+        view = memoryview( body )
+        count, = U16.unpack_from( view, 0 )
+        pos = U16.size
+        for i in range( count ):
+            alen, = U8.unpack_from( view, pos )
+            pos += U8.size
+            addr = tuple( view[pos:pos + alen] )
+            pos += alen
+
+            mlen, = U16.unpack_from( view, pos )
+            pos += U16.size
+            memo = bytes( view[pos:pos + mlen] ).decode( 'utf-8' )
+            pos += mlen
+
+            dlen, = U16.unpack_from( view, pos )
+            pos += U16.size
+            data = tuple( view[pos:pos + dlen] )
+            pos += dlen
+
+            parm = ParmRec( addr, data, memo )
+            obj.parms.append( parm )
+            obj.by_addr[addr] = parm
+
+        return obj
+
+    # Snapshot of the whole library as (id, body) pairs, ready for
+    # write().  Presets that have not changed are copied straight from
+    # the map without being decoded.  Pass a copy of 'added' taken
+    # earlier to build the snapshot on another thread while presets
+    # are still being added.
+    def bodies( self, added=None ):
+        if added == None:
+            added = self.added
+        result = []
+        for program in sorted( set( self._ids() ) | set( added ) ):
+            if program in added:
+                result.append( (program, PresetStore.encode( added[program] )) )
+            else:
+                offset, length, crc = self._find( program )
+                result.append( (program, self.map[offset:offset + length]) )
+        return result
+
+    # Write (id, body) pairs to filename and fsync it
+    @staticmethod
+    def write( filename, bodies ):
+        bodies = sorted( bodies )
+        out = bytearray( HEADER.pack( MAGIC, len( bodies ) ) )
+        offset = HEADER.size + ENTRY.size * len( bodies )
+        for program, body in bodies:
+            out += ENTRY.pack( program, offset, len( body ), zlib.crc32( body ) )
+            offset += len( body )
+        for program, body in bodies:
+            out += body
+
+        with open( filename, 'wb' ) as outfh:
+            outfh.write( out )
+            outfh.flush()
+            os.fsync( outfh.fileno() )
+
+    # Write presets to filename.  Goes via a temporary file that is
+    # renamed into place.
+    @staticmethod
+    def save( filename, recs ):
+        tmpfile = filename + ".tmp"
+        PresetStore.write( tmpfile, [ (rec.id, PresetStore.encode( rec )) for rec in recs ] )
+        os.replace( tmpfile, filename )
+
+
+if __name__ == '__main__':
+    args = sys.argv
+    if len( args ) != 4 or args[1] not in ('to-binary', 'to-text'):
+        print( "Usage: preset_store.py to-binary <text_file> <binary_file>" )
+        print( "       preset_store.py to-text <binary_file> <text_file>" )
+        sys.exit( 1 )
+
+    if args[1] == 'to-binary':
+        with open( args[2], 'r' ) as infh:
+            recs = list( PanelPreset.get_from_file( infh ) )
+        PresetStore.save( args[3], recs )
+    else:
+        store = PresetStore( args[2] )
+        recs = store.values()
+        with open( args[3], 'w' ) as outfh:
+            for rec in recs:
+                rec.serialize( outfh )
+        store.close()
+
+    print( "Converted %d presets" % len( recs ) )
@@ -0,0 +1,221 @@
+# Match sysex query replies to the requests that asked for them.
+#
+# Every outstanding RQ1 is a Query covering an address span
+# [first, last).  An incoming DT1 chunk belongs to the query whose span
+# contains its start address.  Up to 'window' queries may be in flight
+# at once, and two queries with overlapping spans are never in flight
+# together, so every chunk has exactly one owner.  Chunks nobody owns
+# (late replies, unsolicited dumps) are set aside as strays.
+#
+# Addresses are scalars (see Katana.decode_array).
+
+import time
+import threading
+import syslog
+from collections import deque
+
+import metrics
+
+class Query:
+
+    # 'min_count' is a planned chunk count that is not trusted as exact:
+    # the query does not end before that many chunks have arrived, and
+    # after that it ends at the end of the span or once replies pause
+    # for 'idle_gap' seconds.
+    def __init__( self, start, length, target_count=None, expected_bytes=None, timeout=5,
+                  min_count=None, idle_gap=None ):
+        self.span = ( start, start + length )
+        self.target_count = target_count
+        self.expected_bytes = expected_bytes
+        self.timeout = timeout
+        self.min_count = min_count
+        self.idle_gap = idle_gap
+
+        # Reply chunks in arrival order
+        self.addr = []
+        self.data = []
+
+        self.chunk_count = 0
+        self.byte_count = 0
+        self.sent_time = None
+        self.deadline = None
+        self.last_chunk_time = None
+        self.timed_out = False
+        self.done = threading.Event()
+
+    def length( self ):
+        return self.span[1] - self.span[0]
+
+    def covers( self, start ):
+        return self.span[0] <= start < self.span[1]
+
+    def overlaps( self, other ):
+        return self.span[0] < other.span[1] and other.span[0] < self.span[1]
+
+    # Absorb one reply chunk.  Returns True once the query is
+    # complete: the expected number of chunks (or bytes) has arrived,
+    # or a chunk reached the end of the span.
+    def accept( self, start, addr, data, now ):
+        self.addr.append( addr )
+        self.data.append( data )
+        self.chunk_count += 1
+        self.byte_count += len( data )
+        self.last_chunk_time = now
+
+        if start + len( data ) >= self.span[1]:
+            return True
+        if self.target_count != None and self.chunk_count >= self.target_count:
+            return True
+        if self.expected_bytes != None and self.byte_count >= self.expected_bytes:
+            return True
+        return False
+
+
+class QueryEngine:
+
+    # 'send' is called with each Query, under the engine lock, to put
+    # its RQ1 on the wire.
+    def __init__( self, send, window=4 ):
+        self.send = send
+        self.window = max( 1, window )
+
+        self.cond = threading.Condition()
+        self.pending = []
+
+        # Replies that arrive outside any query span are quarantined
+        # here instead of being mixed into a result.
+        self.strays = deque( maxlen=32 )
+        self.stray_count = 0
+        self.timeouts = 0
+
+    # Send a query and return it without waiting for the reply.  Blocks
+    # while the window is full or an overlapping query is in flight.
+    def submit( self, query ):
+        with self.cond:
+            while True:
+                now = time.time()
+                self._expire( now )
+                blockers = [ q for q in self.pending if q.overlaps( query ) ]
+                if len( self.pending ) < self.window and not blockers:
+                    break
+
+                wait = min( q.deadline for q in self.pending ) - now
+                self.cond.wait( max( wait, 0.001 ) )
+
+            query.sent_time = time.time()
+            query.deadline = query.sent_time + query.timeout
+            self.pending.append( query )
+            self.send( query )
+
+        return query
+
+    # Called from the MIDI input thread with each reply chunk.  Returns
+    # the owning Query, or None if the chunk was a stray.
+    def dispatch( self, start, addr, data ):
+        with self.cond:
+            for query in self.pending:
+                if query.covers( start ):
+                    if query.accept( start, addr, data, time.time() ):
+                        self._retire( query )
+                    return query
+
+            self.strays.append( (addr, data) )
+            self.stray_count += 1
+            metrics.count( 'query.strays' )
+            return None
+
+    # Block until 'query' completes or times out and return its
+    # (addr, data) lists.  With 'idle_gap' set, the query also ends
+    # once no chunk has arrived for that long after the first (for
+    # bulk dumps of unknown size).  A query's own idle_gap applies once
+    # its min_count has been reached.
+    def wait( self, query, idle_gap=None ):
+        first = 1
+        if idle_gap == None and query.idle_gap != None:
+            idle_gap = query.idle_gap
+            first = max( query.min_count or 1, 1 )
+
+        while not query.done.is_set():
+            now = time.time()
+            if now >= query.deadline:
+                with self.cond:
+                    self._expire( now )
+                break
+
+            wait = query.deadline - now
+            if idle_gap != None and query.chunk_count >= first:
+                idle_end = query.last_chunk_time + idle_gap
+                if now >= idle_end:
+                    break
+                wait = min( wait, idle_end - now )
+
+            query.done.wait( wait )
+
+        with self.cond:
+            if query in self.pending:
+                self._retire( query )
+
+        return query.addr, query.data
+
+    # Submit every query, keeping up to 'window' in flight, and return
+    # their results in order.
+    def run( self, queries ):
+        for query in queries:
+            self.submit( query )
+        return [ self.wait( query ) for query in queries ]
+
+    # Caller must hold cond
+    def _retire( self, query ):
+        self.pending.remove( query )
+        if not query.timed_out:
+            metrics.record( 'query_round_trip', time.time() - query.sent_time )
+        if query.min_count != None and query.chunk_count != query.min_count:
+            syslog.syslog( "Sysex query at 0x%x: planned %d chunks, amp sent %d" %
+                           (query.span[0], query.min_count, query.chunk_count) )
+            metrics.count( 'query.plan_mismatch' )
+        query.done.set()
+        self.cond.notify_all()
+
+    # Give up on queries past their deadline. Caller must hold cond.
+    def _expire( self, now ):
+        for query in list( self.pending ):
+            if now >= query.deadline:
+                syslog.syslog( "Error: Timeout on sysex query at 0x%x (%d of %d bytes)" %
+                               (query.span[0], query.byte_count, query.length()) )
+                query.timed_out = True
+                self.timeouts += 1
+                metrics.count( 'query.timeouts' )
+                self._retire( query )
+
+
+if __name__ == '__main__':
+    sent = []
+    engine = QueryEngine( sent.append, window=2 )
+
+    a = engine.submit( Query( 0, 300, target_count=2 ) )
+    b = engine.submit( Query( 1000, 10, target_count=1 ) )
+
+    # Replies interleave and arrive out of order; each lands with its
+    # owner and the stray is set aside.
+    engine.dispatch( 1000, 'b0', [0] * 10 )
+    engine.dispatch( 0, 'a0', [0] * 241 )
+    engine.dispatch( 5000, 'x', [0] )
+    engine.dispatch( 241, 'a1', [0] * 59 )
+
+    assert engine.wait( a ) == ( ['a0', 'a1'], [[0] * 241, [0] * 59] )
+    assert engine.wait( b ) == ( ['b0'], [[0] * 10] )
+    assert engine.stray_count == 1 and not engine.pending
+
+    # A planned count is only a lower bound: an extra chunk from the
+    # amp is still collected, and the end of the span completes it.
+    c = engine.submit( Query( 0, 300, min_count=1, idle_gap=0.05 ) )
+    engine.dispatch( 0, 'c0', [0] * 241 )
+    engine.dispatch( 241, 'c1', [0] * 59 )
+    assert engine.wait( c )[0] == ['c0', 'c1']
+
+    # Short of the span's end it finishes once replies go quiet
+    d = engine.submit( Query( 0, 300, min_count=1, idle_gap=0.05 ) )
+    engine.dispatch( 0, 'd0', [0] * 241 )
+    assert engine.wait( d )[0] == ['d0'] and not d.timed_out
+
+    print( "OK" )
@@ -0,0 +1,174 @@
+#!/usr/bin/python3
+#
+# Plan sysex reads.  Given the blocks a caller wants, return the RQ1
+# requests that fetch them, each with the number of reply chunks the
+# model predicts.  The model may lack bytes the real amp defines, so
+# callers treat that count as a minimum (see Katana.range_query).
+#
+# The planner works from a map of the amp's documented memory (see
+# memory_image.py: doc/katana_sysex.txt plus the parameter metadata).
+# Wanted blocks are clipped to it and requests never span a gap in
+# it: the amp may hold undocumented bytes there, and anything read
+# would be saved with a preset and written back on recall.  Blocks
+# that touch are read in one request.
+#
+# Usage: query_planner.py [datadir]   (prints the capture plan)
+#
+
+import os
+import sys
+import json
+
+from globals import *
+import compile_cache
+from katana import Katana
+from memory_image import MemoryImage
+
+# First address byte of the patch (preset) area
+PATCH_AREA = 0x60
+
+# Sorted, disjoint [start, end) runs of defined memory
+class AddressMap:
+
+    def __init__( self, addrs=() ):
+        self.runs = []
+        for addr in sorted( addrs ):
+            if self.runs and self.runs[-1][1] == addr:
+                self.runs[-1][1] = addr + 1
+            else:
+                self.runs.append( [addr, addr + 1] )
+
+    # Build the map of the amp's documented memory
+    @staticmethod
+    def from_parameters( datadir, docfile=None ):
+        image = MemoryImage()
+        if docfile != None and os.path.isfile( docfile ):
+            image.load_doc( docfile )
+        image.load_parameters( datadir )
+        return AddressMap( image.mem.keys() )
+
+    # Defined runs clipped to [start, end)
+    def clip( self, start, end ):
+        result = []
+        for first, last in self.runs:
+            if last <= start:
+                continue
+            if first >= end:
+                break
+            result.append( (max( first, start ), min( last, end )) )
+        return result
+
+    # Reply chunks and data bytes the amp sends for a read of [start, end)
+    def cost( self, start, end, chunk_size=MAX_CHUNK ):
+        chunks = 0
+        count = 0
+        for first, last in self.clip( start, end ):
+            chunks += (last - first + chunk_size - 1) // chunk_size
+            count += last - first
+        return chunks, count
+
+
+class QueryPlanner:
+
+    def __init__( self, address_map, chunk_size=MAX_CHUNK ):
+        self.map = address_map
+        self.chunk_size = chunk_size
+
+    # Takes a list of (addr, length) blocks and returns request records
+    # in the same form as ranges.json, plus the expected 'chunks' and
+    # 'bytes' of each reply.  Undefined bytes are dropped from the
+    # wanted set.
+    def plan( self, blocks, name='range' ):
+        wanted = []
+        for addr, length in blocks:
+            start = Katana.decode_array( addr )
+            wanted.extend( self.map.clip( start, start + length ) )
+
+        # Union of wanted spans.  Spans are clipped to defined runs, so
+        # only pieces of the same run can touch.
+        requests = []
+        for start, end in sorted( wanted ):
+            if requests and start <= requests[-1][1]:
+                requests[-1][1] = max( requests[-1][1], end )
+            else:
+                requests.append( [start, end] )
+
+        result = []
+        for i, (start, end) in enumerate( requests ):
+            chunks, count = self.map.cost( start, end, self.chunk_size )
+            result.append( { "name": "%s%d" % (name, i + 1),
+                             "baseAddr": Katana.encode_scalar( start ),
+                             "lastAddr": Katana.encode_scalar( end - 1 ),
+                             "chunks": chunks,
+                             "bytes": count } )
+        return result
+
+    # Requests covering all of the patch area, for preset capture
+    def capture_plan( self ):
+        blocks = []
+        for first, last in self.map.runs:
+            if Katana.encode_scalar( first )[0] == PATCH_AREA:
+                blocks.append( (Katana.encode_scalar( first ), last - first) )
+        return self.plan( blocks )
+
+
+# Wanted (addr, length) blocks described by a parameter file
+# (amplifier.json, simple_dsp.json, complex_dsp.json, color_assign.json
+# or system.json)
+def parameter_blocks( parmfile ):
+    with open( parmfile ) as fh:
+        parms = json.load( fh )
+
+    blocks = []
+    def walk( node ):
+        if isinstance( node, dict ):
+            if 'baseAddr' in node and 'length' in node:
+                blocks.append( (node['baseAddr'], node['length']) )
+            elif 'addr' in node:
+                blocks.append( (node['addr'], 1) )
+            for child in node.values():
+                walk( child )
+
+    walk( parms )
+
+    # complex_dsp.json keeps block addresses apart from their lengths
+    if 'class' in parms and 'baseAddr' in parms:
+        for category, table in parms['baseAddr'].items():
+            for dsp, base in table.items():
+                blocks.append( (base, parms['parameters'][dsp]['length']) )
+
+    return blocks
+
+# Drop-in replacement for Range, with ranges generated by the planner
+# instead of read from ranges.json.  The plan is cached, since building
+# the address map means parsing the sysex doc and all the metadata.
+class CaptureRange:
+
+    SOURCES = ( 'ranges.json', 'amplifier.json', 'simple_dsp.json', 'complex_dsp.json',
+                'color_assign.json', 'system.json' )
+
+    def __init__( self, datadir, docfile=None ):
+        if docfile == None:
+            docfile = os.path.join( datadir, '..', 'doc', 'katana_sysex.txt' )
+
+        def build():
+            planner = QueryPlanner( AddressMap.from_parameters( datadir, docfile ) )
+            return planner.capture_plan()
+
+        sources = [ os.path.join( datadir, name ) for name in self.SOURCES ]
+        sources.append( docfile )
+        self.recs = compile_cache.cached( 'capture_plan.cache', sources, build, version=2 )
+
+    def get_coords( self ):
+        return self.recs
+
+
+if __name__ == '__main__':
+    scriptdir = os.path.dirname( os.path.abspath(__file__) )
+    datadir = sys.argv[1] if len( sys.argv ) > 1 else scriptdir + '/parameters/'
+
+    recs = CaptureRange( datadir ).get_coords()
+    for rec in recs:
+        print( "%-8s %-18s %-18s %2d chunks %4d bytes" %
+               (rec['name'], rec['baseAddr'], rec['lastAddr'], rec['chunks'], rec['bytes']) )
+    print( "%d requests, %d bytes" % (len( recs ), sum( rec['bytes'] for rec in recs )) )
@@ -0,0 +1,109 @@
+# Byte-addressed image of what we believe the amplifier's memory
+# currently holds.  Kept up to date from every write we send and every
+# reply we read, so a preset recall can send only what has changed.
+# Each byte also carries the time it was last written or read, so the
+# image can answer reads while it is fresh (see Katana's read cache).
+#
+# Addresses are scalars (see Katana.decode_array).
+
+import time
+from itertools import repeat
+
+from globals import FRAME_OVERHEAD
+
+class ShadowImage:
+
+    def __init__( self ):
+        self.mem = {}
+        self.stamp = {}
+        self.bytes_skipped = 0
+
+    # Forget everything, e.g. after the amp changed channel
+    def clear( self ):
+        self.mem = {}
+        self.stamp = {}
+
+    # Keep the image for write diffs but stop answering reads from it,
+    # e.g. after something we cannot track changed the amp
+    def expire( self ):
+        self.stamp = {}
+
+    # Record data at start, fresh as of now
+    def update( self, start, data ):
+        span = range( start, start + len( data ) )
+        self.mem.update( zip( span, data ) )
+        self.stamp.update( zip( span, repeat( time.monotonic() ) ) )
+
+    # Return known bytes for a span, or None if any are unknown
+    def get( self, start, length ):
+        try:
+            return [ self.mem[ start + i ] for i in range( length ) ]
+        except KeyError:
+            return None
+
+    # Return a span if every byte was seen within 'ttl' seconds, else
+    # None
+    def fresh( self, start, length, ttl ):
+        oldest = time.monotonic() - ttl
+        stamp = self.stamp
+        try:
+            for i in range( start, start + length ):
+                if stamp[i] < oldest:
+                    return None
+        except KeyError:
+            return None
+        return self.get( start, length )
+
+    # Compare proposed data against the image and return the list of
+    # (start, [data]) spans that need to be sent.  Unknown bytes count
+    # as changed. Spans separated by a short run of unchanged bytes
+    # are merged when that costs less than a second message.
+    def diff( self, start, data ):
+        mem = self.mem
+        spans = []
+        first = None
+        last = None
+        for i, byte in enumerate( data ):
+            if mem.get( start + i ) == byte:
+                continue
+            if first != None and i - last - 1 > FRAME_OVERHEAD:
+                spans.append( (first, last) )
+                first = None
+            if first == None:
+                first = i
+            last = i
+
+        if first != None:
+            spans.append( (first, last) )
+
+        sent = 0
+        result = []
+        for first, last in spans:
+            result.append( (start + first, list( data[first:last + 1] )) )
+            sent += last - first + 1
+
+        self.bytes_skipped += len( data ) - sent
+        return result
+
+
+if __name__ == '__main__':
+    shadow = ShadowImage()
+    assert shadow.diff( 100, [1, 2, 3] ) == [ (100, [1, 2, 3]) ]
+
+    shadow.update( 100, list( range( 40 ) ) )
+    assert shadow.diff( 100, list( range( 40 ) ) ) == []
+
+    # Nearby changes merge, distant ones do not
+    changed = list( range( 40 ) )
+    changed[2] = 99
+    changed[5] = 99
+    changed[35] = 99
+    assert shadow.diff( 100, changed ) == [ (102, [99, 3, 4, 99]), (135, [99]) ]
+
+    # Reads are only answered while fresh
+    assert shadow.fresh( 100, 3, 1.0 ) == [0, 1, 2]
+    assert shadow.fresh( 100, 3, 0.0 ) == None
+    assert shadow.fresh( 139, 2, 1.0 ) == None
+    shadow.expire()
+    assert shadow.fresh( 100, 3, 1.0 ) == None and shadow.get( 100, 3 ) == [0, 1, 2]
+    print( "OK" )
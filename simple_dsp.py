@@ -32,7 +32,13 @@ class SimpleDSP:
     #
     # Returns model name and parameter block descriptor
     #
-    def get_coords( self, category, model_enum ):
+    def get_coords( self, category, model_enum=None ):
+        # Also accepts a record from ColorButtons.read_knobs() or
+        # read_color_assign() as the only argument
+        if isinstance( category, dict ):
+            model_enum = category['type']
+            category = category['category']
+
         # Lookup model name (TrebleBoost, BluesDrive, Spring, Hall, etc)
         name = self.models[category]['enum2name'][model_enum]
 
@@ -63,5 +69,5 @@ if __name__ == '__main__':
     
     for dsp_rec in dsp_recs:
         if dsp_rec['group'] == 'simple':
-            coords = simpleObj.get_coords( dsp_rec['category'], dsp_rec['type'] ) 
+            coords = simpleObj.get_coords( dsp_rec ) 
             print( "Name: ", coords['name'], ", Blocks: ", coords['blocks']  )
@@ -0,0 +1,56 @@
+# Startup timing for the bridge.  katana_bridge_start exports the time
+# the amp or controller was plugged in (KATANA_T0, stamped by the udev
+# rule) so the bridge can report plug-in-to-ready time, broken down by
+# phase, once it is able to honour the first PC.
+#
+# Profile mode (KATANA_PROFILE set in the environment, or a file named
+# 'profile' in /var/run/katana) also runs the bridge under
+# 'python3 -X importtime' and writes everything to
+# /var/run/katana/profile.log.
+
+import os
+import sys
+import time
+import syslog
+
+RUNDIR = "/var/run/katana/"
+PROFILE_LOG = RUNDIR + "profile.log"
+
+def profiling():
+    return os.environ.get( 'KATANA_PROFILE' ) != None or os.path.exists( RUNDIR + "profile" )
+
+class StartupTimer:
+
+    def __init__( self ):
+        now = time.time()
+        t0 = os.environ.get( 'KATANA_T0' )
+        try:
+            self.start = float( t0 )
+        except ( TypeError, ValueError ):
+            self.start = now
+
+        self.last = self.start
+        self.phases = []
+
+        # Time spent before this process got going (udev, at, the
+        # start script)
+        if now > self.start:
+            self.mark( 'launch' )
+
+    # End the current phase
+    def mark( self, phase ):
+        now = time.time()
+        self.phases.append( (phase, now - self.last) )
+        self.last = now
+
+    def total( self ):
+        return self.last - self.start
+
+    def report( self ):
+        text = "Ready %d ms after start (%s)" % (
+            self.total() * 1000,
+            ", ".join( "%s %d ms" % (phase, elapsed * 1000) for phase, elapsed in self.phases ) )
+        syslog.syslog( text )
+        if profiling():
+            print( text, file=sys.stderr )
+        return text
@@ -0,0 +1,203 @@
+# Optional recorder for MIDI traffic.  When enabled, every message the
+# bridge receives from the controller, sends to the amp or receives
+# from the amp is logged with its direction, port and a monotonic
+# timestamp.  A log can be listed, or its controller input played back
+# into a running bridge for a reproducible test:
+#
+#   traffic_log.py show <log>
+#   traffic_log.py replay <log> <port> [speed] [virt]
+#
+# 'replay' sends to the named MIDI port at the recorded pace divided by
+# 'speed' (default 1; 0 sends as fast as possible).  With 'virt' it
+# creates a virtual port of that name for the bridge to connect to.
+#
+# Recording is enabled by setting KATANA_RECORD to a file name, or by
+# creating a file named 'record' in /var/run/katana (the log then goes
+# next to the preset file, named by the start time).
+#
+# Callers only append to an in-memory queue; a background thread
+# writes the queue out every half second.  If the writer falls too far
+# behind, new records are dropped (and counted) rather than blocking
+# MIDI handling.
+#
+# Layout (little-endian):
+#
+#   header:  magic[8]  wall_time:f64  monotonic_time:f64
+#   records: direction:u8  port:u8  monotonic_time:f64  length:u16
+#            bytes[length]
+
+import os
+import sys
+import time
+import struct
+import threading
+from collections import deque
+
+from startup import RUNDIR
+
+MAGIC = b'KTNMIDI1'
+HEADER = struct.Struct( '<8sdd' )
+RECORD = struct.Struct( '<BBdH' )
+
+# Directions
+IN = 0
+OUT = 1
+
+# Ports
+CONTROLLER = 0
+AMP = 1
+
+class TrafficRecorder:
+
+    def __init__( self, filename, flush_interval=0.5, max_pending=100000 ):
+        self.filename = filename
+        self.flush_interval = flush_interval
+        self.max_pending = max_pending
+        self.pending = deque()
+        self.records = 0
+        self.dropped = 0
+
+        self.fh = open( filename, 'wb' )
+        self.fh.write( HEADER.pack( MAGIC, time.time(), time.monotonic() ) )
+
+        self.stopping = threading.Event()
+        self.thread = threading.Thread( target=self._run, daemon=True )
+        self.thread.start()
+
+    # Called from any thread.  Never blocks.
+    def record( self, direction, port, data ):
+        if len( self.pending ) >= self.max_pending:
+            self.dropped += 1
+            return
+        self.pending.append( RECORD.pack( direction, port, time.monotonic(), len( data ) ) + bytes( data ) )
+
+    def _run( self ):
+        while not self.stopping.wait( self.flush_interval ):
+            self._flush()
+
+    def _flush( self ):
+        chunks = []
+        while self.pending:
+            chunks.append( self.pending.popleft() )
+        if chunks:
+            self.fh.write( b''.join( chunks ) )
+            self.fh.flush()
+            self.records += len( chunks )
+
+    def close( self ):
+        self.stopping.set()
+        self.thread.join()
+        self._flush()
+        self.fh.close()
+
+
+# Generator of (direction, port, time, bytes) from a log.  Times are
+# seconds since recording started.
+def read_log( filename ):
+    with open( filename, 'rb' ) as fh:
+        header = fh.read( HEADER.size )
+        if len( header ) < HEADER.size or header[:len( MAGIC )] != MAGIC:
+            raise ValueError( "%s is not a traffic log" % filename )
+        magic, wall_time, start = HEADER.unpack( header )
+
+        while True:
+            head = fh.read( RECORD.size )
+            if len( head ) < RECORD.size:
+                return
+            direction, port, when, length = RECORD.unpack( head )
+            data = fh.read( length )
+            if len( data ) < length:
+                return
+            yield direction, port, when - start, data
+
+
+recorder = None
+
+# Log file requested through the environment or the run directory, or
+# None if recording is off
+def requested( logdir ):
+    filename = os.environ.get( 'KATANA_RECORD' )
+    if filename:
+        return filename
+    if os.path.exists( RUNDIR + "record" ):
+        return os.path.join( logdir, time.strftime( "traffic-%Y%m%d-%H%M%S.log" ) )
+    return None
+
+def start( filename ):
+    global recorder
+    recorder = TrafficRecorder( filename )
+    return recorder
+
+def stop():
+    global recorder
+    if recorder != None:
+        recorder.close()
+        recorder = None
+
+# Log a mido message, if recording
+def record( direction, port, msg ):
+    if recorder != None:
+        recorder.record( direction, port, msg.bin() )
+
+
+PORTS = { CONTROLLER: 'controller', AMP: 'amp' }
+
+def show( filename ):
+    import mido
+    from metrics import Histogram
+
+    counts = {}
+    latency = Histogram()
+    waiting = None
+    for direction, port, when, data in read_log( filename ):
+        msg = mido.Message.from_bytes( data )
+        key = ( PORTS[port], 'in' if direction == IN else 'out' )
+        counts[key] = counts.get( key, 0 ) + 1
+        print( "%10.4f %-10s %-3s %s" % (when, key[0], key[1], msg) )
+
+        # Controller PC to the first message sent to the amp
+        if port == CONTROLLER and msg.type == 'program_change':
+            waiting = when
+        elif port == AMP and direction == OUT and waiting != None:
+            latency.record( when - waiting )
+            waiting = None
+
+    for key in sorted( counts ):
+        print( "%s %s: %d messages" % (key[0], key[1], counts[key]) )
+    print( "PC to first amp write: %s" % latency.summary() )
+
+# Send the controller input of a log to 'portname'
+def replay( filename, portname, speed=1.0, virtual=False ):
+    import mido
+    records = [ (when, data) for direction, port, when, data in read_log( filename )
+                if direction == IN and port == CONTROLLER ]
+
+    with mido.open_output( portname, virtual=virtual ) as outport:
+        if virtual:
+            # Give the bridge a moment to find the port
+            time.sleep( 1 )
+
+        start = time.monotonic()
+        first = records[0][0] if records else 0
+        for when, data in records:
+            if speed > 0:
+                delay = start + (when - first) / speed - time.monotonic()
+                if delay > 0:
+                    time.sleep( delay )
+            outport.send( mido.Message.from_bytes( data ) )
+
+    print( "Replayed %d messages in %.2f s" % (len( records ), time.monotonic() - start) )
+
+
+if __name__ == '__main__':
+    args = sys.argv
+    if len( args ) >= 3 and args[1] == 'show':
+        show( args[2] )
+    elif len( args ) >= 4 and args[1] == 'replay':
+        speed = float( args[4] ) if len( args ) > 4 else 1.0
+        virtual = len( args ) > 5 and args[5] == 'virt'
+        replay( args[2], args[3], speed, virtual )
+    else:
+        print( "Usage: traffic_log.py show <log>" )
+        print( "       traffic_log.py replay <log> <port> [speed] [virt]" )
+        sys.exit( 1 )
@@ -0,0 +1,120 @@
+# Plan outgoing sysex writes.  Takes the writes a caller would like to
+# make, in order, and returns the fewest DT1 messages that leave the
+# amp in the same state:
+#
+#  - writes that touch adjacent or overlapping addresses are merged
+#    into one block (the later write wins on overlap)
+#  - blocks larger than the amp's safe payload are split
+#  - address gaps are never bridged, since the gap may be undefined
+#    memory on the amp
+#  - delay records are ordering barriers; nothing is merged or
+#    reordered across them
+#
+# Addresses are scalars (see Katana.decode_array).  A delay is given
+# as (None, msec).
+
+from globals import MAX_CHUNK, FRAME_OVERHEAD
+
+class WritePlanner:
+
+    def __init__( self, max_payload=MAX_CHUNK ):
+        self.max_payload = max_payload
+
+        self.writes_in = 0
+        self.bytes_in = 0
+        self.messages_out = 0
+        self.bytes_out = 0
+
+    # Returns list of (start, [data]) messages and (None, msec) delays.
+    # If 'filter' is given it is called with each merged block and
+    # returns the list of (start, [data]) spans that actually need
+    # sending (e.g. ShadowImage.diff).
+    def plan( self, writes, filter=None ):
+        steps = []
+        segment = []
+        for start, data in writes:
+            if start == None:
+                steps.extend( self._plan_segment( segment, filter ) )
+                steps.append( (None, data) )
+                segment = []
+            else:
+                segment.append( (start, data) )
+                self.writes_in += 1
+                self.bytes_in += len( data ) + FRAME_OVERHEAD
+
+        steps.extend( self._plan_segment( segment, filter ) )
+        return steps
+
+    def _plan_segment( self, segment, filter ):
+        if not segment:
+            return []
+
+        blocks = WritePlanner.merge( segment )
+        if filter != None:
+            filtered = []
+            for start, data in blocks:
+                filtered.extend( filter( start, data ) )
+            blocks = filtered
+
+        # Split oversized blocks
+        steps = []
+        for start, data in blocks:
+            for offset in range( 0, len( data ), self.max_payload ):
+                chunk = list( data[offset:offset + self.max_payload] )
+                steps.append( (start + offset, chunk) )
+                self.messages_out += 1
+                self.bytes_out += len( chunk ) + FRAME_OVERHEAD
+
+        return steps
+
+    # Merge (start, [data]) writes into the contiguous (start, [data])
+    # blocks they leave in memory.  The last writer wins for any byte
+    # written more than once.
+    @staticmethod
+    def merge( writes ):
+        image = {}
+        for start, data in writes:
+            for i, byte in enumerate( data ):
+                image[ start + i ] = byte
+
+        blocks = []
+        first = None
+        run = []
+        for addr in sorted( image ):
+            if run and addr != prev + 1:
+                blocks.append( (first, run) )
+                run = []
+            if not run:
+                first = addr
+            run.append( image[addr] )
+            prev = addr
+        if run:
+            blocks.append( (first, run) )
+        return blocks
+
+    def messages_saved( self ):
+        return self.writes_in - self.messages_out
+
+    def bytes_saved( self ):
+        return self.bytes_in - self.bytes_out
+
+
+if __name__ == '__main__':
+    planner = WritePlanner( max_payload=4 )
+
+    # Adjacent and overlapping writes merge; later write wins
+    steps = planner.plan( [ (10, [1, 2]), (12, [3]), (11, [9]), (20, [5]) ] )
+    assert steps == [ (10, [1, 9, 3]), (20, [5]) ], steps
+
+    # Delay is a barrier
+    steps = planner.plan( [ (10, [1]), (None, 50), (11, [2]) ] )
+    assert steps == [ (10, [1]), (None, 50), (11, [2]) ], steps
+
+    # Oversized blocks split at max payload
+    steps = planner.plan( [ (0, list( range( 10 ) )) ] )
+    assert [ len( d ) for s, d in steps ] == [4, 4, 2], steps
+
+    # Final image across delays: later writes replace earlier ones
+    assert WritePlanner.merge( [ (10, [0]), (11, [1, 2]), (10, [7]) ] ) == [ (10, [7, 1, 2]) ]
+
+    print( "OK: saved %d messages, %d bytes" % (planner.messages_saved(), planner.bytes_saved()) )